@@ -0,0 +1 @@
+../chunkstore.py
\ No newline at end of file
@@ -6,7 +6,51 @@ Please download the data from https://huggingface.co/datasets/ctheodoris/Genecor
 
 IMAGE = "public.ecr.aws/outerbounds/geneformer:latest"
 
+# stream the organ train/eval shards from the datastore during finetuning instead of
+# downloading both splits before training starts
+STREAM_TRAINING_DATA = False
+# shards fetched ahead of the one being read
+STREAM_PREFETCH_SHARDS = 2
+# shards kept on local disk, least recently used shards are deleted first
+STREAM_CACHE_SHARDS = 4
+
+# preprocessing
+# organs trained together with another organ (immune and bone marrow are included together)
+ORGAN_MERGE = {"bone_marrow": "immune"}
+# per scDeepsort published method, drop cell types representing <0.5% of an organ's cells
+RARE_CELL_TYPE_FRACTION = 0.005
+# seed of the shuffle before the train/eval split
+SHUFFLE_SEED = 42
+# fraction of each organ's cells used for training, the rest is used for evaluation
+TRAIN_FRACTION = 0.8
+# split every cell type 80/20 instead of the whole organ, every eval cell type is then seen in training
+STRATIFIED_SPLIT = True
+# reuse organ splits stored by a previous run with the same input data and preprocessing rules,
+# False preprocesses again and stores the splits under a key of their own
+PREPROCESS_CACHE = True
+# organ splits built or uploading at the same time, bounds preprocess memory to about N organs
+PREPROCESS_MAX_INFLIGHT_ORGANS = 2
+
+# packed training: train several organs back to back in each finetune task, loading the
+# pretrained backbone once per task. Organs are binned by split size into at most this many tasks.
+PACKED_TRAINING = False
+PACKED_NUM_WORKERS = 4
+
+# distributed data-parallel finetuning, one worker process per device (NCCL on GPU, gloo on CPU)
+DISTRIBUTED_TRAINING = False
+# number of workers, None for every visible GPU or NUM_CPUS workers on CPU-only nodes
+DISTRIBUTED_WORKERS = None
+
+# attempts of a finetune task after a failure or preemption, each resumes from the
+# latest checkpoint streamed to the datastore
+FINETUNE_RETRIES = 2
+# stream checkpoints through the deduplicating chunk store, sending tensors unchanged since
+# an earlier checkpoint, of any organ or run, only once
+CHUNKED_CHECKPOINTS = True
+
 # set model parameters
+# pretrained model, absolute path set in Dockerfile
+PRETRAINED_MODEL_PATH = "/Geneformer/geneformer-12L-30M"
 # max input size
 MAX_INPUT_SIZE = 2**11  # 2048
 
@@ -21,6 +65,38 @@ NUM_GPUS = 1
 NUM_CPUS = 4
 # batch size for training and eval
 GENEFORMER_BATCH_SIZE = 1 # NOTE: 12 raised OOM on 16GB GPU
+# pack batches up to this many padded tokens (batch size x longest cell) using the
+# dataset's length column instead of a fixed batch size, e.g. 12 * 2048. None disables it.
+MAX_TOKENS_PER_BATCH = None
+# training profiles, each sets:
+#   freeze_embeddings: freeze the embedding layer
+#   freeze_layers: freeze the first N encoder layers
+#   gradient_checkpointing: recompute activations in the backward pass instead of storing them
+#   mixed_precision: "bf16", "fp16", "auto" (bf16 where supported, else fp16 on GPU) or None
+#   effective_batch_size: accumulate gradients until this many cells per optimizer step, None for no accumulation
+TRAINING_PROFILES = {
+    "default": {
+        "freeze_embeddings": FREEZE_LAYERS > 0,
+        "freeze_layers": FREEZE_LAYERS,
+        "gradient_checkpointing": False,
+        "mixed_precision": None,
+        "effective_batch_size": None,
+    },
+    "memory_efficient": {
+        "freeze_embeddings": True,
+        "freeze_layers": 6,
+        "gradient_checkpointing": True,
+        "mixed_precision": "auto",
+        "effective_batch_size": 12,
+    },
+}
+# profile used by finetune, peak memory and step time are saved to profile_results.json
+TRAINING_PROFILE = "default"
+# eval predictions are saved as predictions.arrow with the eval dataset row, the label, the
+# predicted label and the top k labels and their probabilities (float16) of every eval cell
+PREDICTIONS_TOP_K = 5
+# also save the full float16 logits as logits.npy, memory-mapped with np.load(mmap_mode="r")
+PREDICTIONS_SAVE_LOGITS = False
 # learning schedule
 LR_SCHEDULE_FN = "linear"
 # warmup steps
@@ -29,3 +105,57 @@ WARMUP_STEPS = 5  # 500
 EPOCHS = 2  # 10
 # optimizer
 OPTIMIZER = "adamw"
+
+# finetuning mode, see ModelOps._add_lora_adapters
+# "full" updates every weight, "lora" trains low-rank adapters and the classification head
+# only (requires peft) and saves just those, composed onto PRETRAINED_MODEL_PATH when loaded
+FINETUNE_MODE = "full"
+LORA_R = 8
+LORA_ALPHA = 16
+LORA_DROPOUT = 0.1
+# attention projections the adapters are added to
+LORA_TARGET_MODULES = ["query", "value"]
+
+# hyperparameter sweep, see sweep_flow.py
+# search space, each entry is ("loguniform", low, high), ("uniform", low, high) or ("choice", options)
+SWEEP_SPACE = {
+    "max_lr": ("loguniform", 1e-5, 5e-4),
+    "warmup_steps": ("choice", [0, 5, 100, 500]),
+    "freeze_layers": ("choice", [0, 2, 4, 6]),
+    "lr_schedule_fn": ("choice", ["linear", "cosine", "polynomial"]),
+}
+# trials sampled from the space, the top 1/SWEEP_ETA of each rung is promoted to the next
+SWEEP_NUM_TRIALS = 9
+SWEEP_ETA = 3
+# total epochs trained by the trials of each of the three rungs, promoted trials resume
+# from their checkpoint of the previous rung
+SWEEP_RUNG_EPOCHS = [1, 3, 9]
+# organ the trials are trained and compared on, None for the organ with the most data
+SWEEP_ORGAN = None
+# eval metric trials are ranked by
+SWEEP_METRIC = "eval_macro_f1"
+SWEEP_SEED = 42
+
+# frozen-backbone embeddings and heads, see embedding_flow.py and head_flow.py
+# hidden state the cell embeddings are mean-pooled from, -1 for the last layer
+EMBEDDING_LAYER = -1
+# padded tokens per length-sorted batch of the embedding pass
+EMBEDDING_MAX_TOKENS_PER_BATCH = 32 * 2048
+# hidden units of the head, None for a linear head
+HEAD_HIDDEN_SIZE = None
+HEAD_EPOCHS = 30
+HEAD_LR = 1e-3
+HEAD_WEIGHT_DECAY = 1e-4
+HEAD_BATCH_SIZE = 256
+
+# batch inference, see inference.py and inference_flow.py
+# padded tokens per length-sorted inference batch
+INFERENCE_MAX_TOKENS_PER_BATCH = 32 * 2048
+# cells per prediction shard
+INFERENCE_ROWS_PER_SHARD = 100_000
+# "eager" PyTorch, or an int8-quantized "torchscript" or "onnx" export for CPU nodes
+INFERENCE_BACKEND = "eager"
+# parallel inference tasks, each scores a contiguous range of cells
+INFERENCE_TASKS = 4
+# cells timed per backend by the inference benchmark
+INFERENCE_BENCHMARK_CELLS = 512
@@ -0,0 +1,62 @@
+from metaflow import FlowSpec, step, kubernetes
+import os
+from utils import DataStore, ModelOps
+from datastore import MANIFEST_NAME
+from config import *
+
+
+class CellEmbeddingPrecompute(FlowSpec, DataStore, ModelOps):
+    """
+    This workflow embeds the cells of every organ split with the frozen pretrained model,
+    in one forward-only pass per split, for head training with head_flow.py.
+
+    Embeddings are stored as float16 .npy arrays next to the organ splits, keyed by the
+    model and layer they came from. Organs embedded by an earlier run are skipped.
+    Embedding settings are set in config.py.
+    """
+
+    @step
+    def start(self):
+        self.model_splits, self.preprocess_cache_hit = self._load_model_splits(
+            os.path.join(DATA_KEY, DATA_DIR)
+        )
+        self.next(self.embed, foreach="model_splits")
+
+    @kubernetes(gpu=NUM_GPUS, cpu=NUM_CPUS, image=IMAGE)
+    @step
+    def embed(self):
+        import shutil
+        import numpy as np
+        from embeddings import load_backbone, compute_embeddings
+
+        split = self.input
+        self.organ = split["organ"]
+        embeddings_key = self._embeddings_key(split)
+        # the manifest is written last, a partial upload of an earlier attempt is redone
+        if self.backend.exists(os.path.join(embeddings_key, MANIFEST_NAME)):
+            print(f"Embeddings of {self.organ} already stored under {embeddings_key}")
+        else:
+            model = load_backbone()
+            # whole columns are read, so the splits are downloaded rather than streamed
+            organ_trainset, organ_evalset = self._load_split(split, stream=False)
+            output_dir = f"{self.organ}_embeddings"
+            os.makedirs(output_dir, exist_ok=True)
+            for name, dataset in (("train", organ_trainset), ("eval", organ_evalset)):
+                compute_embeddings(model, dataset, os.path.join(output_dir, f"{name}_embeddings.npy"))
+                np.save(os.path.join(output_dir, f"{name}_labels.npy"), np.asarray(dataset["label"]))
+            self.upload(local_path=output_dir, store_key=embeddings_key)
+            shutil.rmtree(output_dir, ignore_errors=True)
+        self.next(self.join)
+
+    @step
+    def join(self, inputs):
+        self.organs = [inp.organ for inp in inputs]
+        self.next(self.end)
+
+    @step
+    def end(self):
+        print(f"Embeddings stored for {len(self.organs)} organs, train heads with head_flow.py")
+
+
+if __name__ == "__main__":
+    CellEmbeddingPrecompute()
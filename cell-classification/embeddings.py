@@ -0,0 +1,124 @@
+"""
+Frozen-backbone cell embeddings and classification heads trained on them.
+
+compute_embeddings runs one forward-only pass of the pretrained model over a dataset and
+writes mean-pooled cell embeddings to a float16 .npy file that is read back memory-mapped.
+train_head fits a linear or MLP head on those embeddings on CPU.
+"""
+from config import *
+import modelstore
+
+
+def load_backbone(pretrained_path=PRETRAINED_MODEL_PATH, device=None):
+    "Pretrained encoder in eval mode, loaded through the model store."
+    import torch
+    from transformers import BertModel
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    model = modelstore.load_model(BertModel, pretrained_path, add_pooling_layer=False)
+    return model.to(device).eval()
+
+
+def compute_embeddings(
+    model,
+    dataset,
+    output_path,
+    layer=EMBEDDING_LAYER,
+    max_tokens=EMBEDDING_MAX_TOKENS_PER_BATCH,
+):
+    """
+    Parameters
+    ----------
+    model : BertModel
+        Encoder the cells are embedded with.
+    dataset : datasets.Dataset
+        Tokenized cells with input_ids and length columns.
+    output_path : str
+        .npy file the (cells, hidden size) float16 embeddings are written to, in dataset order.
+    layer : int
+        Index into the hidden states, -1 for the last layer.
+    max_tokens : int
+        Padded tokens per length-sorted batch.
+
+    Returns
+    -------
+    numpy.memmap
+        The embeddings, memory-mapped read-only.
+    """
+    import numpy as np
+    import torch
+    from inference import iter_batches
+
+    device = next(model.parameters()).device
+    embeddings = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=np.float16, shape=(len(dataset), model.config.hidden_size)
+    )
+    with torch.inference_mode(), torch.autocast(
+        device.type, dtype=torch.float16, enabled=device.type == "cuda"
+    ):
+        for rows, input_ids, attention_mask in iter_batches(dataset, max_tokens):
+            attention_mask = attention_mask.to(device)
+            hidden = model(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask,
+                output_hidden_states=True,
+            ).hidden_states[layer]
+            # mean over each cell's genes, padding excluded
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(1) / mask.sum(1)
+            embeddings[rows] = pooled.float().cpu().numpy().astype(np.float16)
+    embeddings.flush()
+    del embeddings
+    return np.load(output_path, mmap_mode="r")
+
+
+def _head(input_size, num_labels, hidden_size=HEAD_HIDDEN_SIZE):
+    import torch
+
+    if hidden_size is None:
+        return torch.nn.Linear(input_size, num_labels)
+    return torch.nn.Sequential(
+        torch.nn.Linear(input_size, hidden_size),
+        torch.nn.GELU(),
+        torch.nn.Dropout(0.1),
+        torch.nn.Linear(hidden_size, num_labels),
+    )
+
+
+def train_head(
+    train_embeddings,
+    train_labels,
+    eval_embeddings,
+    num_labels,
+    hidden_size=HEAD_HIDDEN_SIZE,
+    epochs=HEAD_EPOCHS,
+    lr=HEAD_LR,
+    weight_decay=HEAD_WEIGHT_DECAY,
+    batch_size=HEAD_BATCH_SIZE,
+    seed=SHUFFLE_SEED,
+):
+    """
+    Fit a linear head (or an MLP with hidden_size units) on CPU with AdamW and
+    cross-entropy. Returns the head and its float32 logits on eval_embeddings.
+    """
+    import numpy as np
+    import torch
+
+    torch.manual_seed(seed)
+    x = torch.from_numpy(np.asarray(train_embeddings, dtype=np.float32))
+    y = torch.from_numpy(np.asarray(train_labels, dtype=np.int64))
+    head = _head(x.shape[1], num_labels, hidden_size)
+    optimizer = torch.optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    head.train()
+    for _ in range(epochs):
+        for batch in torch.randperm(len(x)).split(batch_size):
+            optimizer.zero_grad()
+            loss_fn(head(x[batch]), y[batch]).backward()
+            optimizer.step()
+
+    head.eval()
+    with torch.inference_mode():
+        logits = head(torch.from_numpy(np.asarray(eval_embeddings, dtype=np.float32)))
+    return head, logits.numpy()
@@ -1,6 +1,7 @@
-from metaflow import FlowSpec, step, kubernetes, current
+from metaflow import FlowSpec, step, kubernetes, retry, current
 import os
 import sys
+import json
 import subprocess
 from utils import DataStore, ModelOps
 from config import *
@@ -26,56 +27,92 @@ class CellClassificationFinetuning(FlowSpec, DataStore, ModelOps):
 
     @step
     def preprocess(self):
-        from datasets import load_from_disk
+        from utils import pack_organs
 
-        self.download(
-            download_path=DATA_DIR, store_key=os.path.join(DATA_KEY, DATA_DIR)
+        self.model_splits, self.preprocess_cache_hit = self._load_model_splits(
+            os.path.join(DATA_KEY, DATA_DIR)
         )
-        train_dataset = load_from_disk(DATA_DIR)
-        (
-            trainset_dict,
-            traintargetdict_dict,
-            evalset_dict,
-            organ_list,
-        ) = self._preprocess(train_dataset)
-        self.model_splits = []
-        for organ in organ_list:
-            organ_trainset = trainset_dict[organ]
-            organ_evalset = evalset_dict[organ]
-            organ_label_dict = traintargetdict_dict[organ]
-            train_key = os.path.join(DATA_KEY, str(current.run_id), f"{organ}_trainset")
-            self.upload_hf_dataset(organ_trainset, train_key)
-            eval_key = os.path.join(DATA_KEY, str(current.run_id), f"{organ}_evalset")
-            self.upload_hf_dataset(organ_evalset, eval_key)
-            self.model_splits.append(
-                {
-                    "organ": organ,
-                    "organ_trainset_key": train_key,
-                    "organ_evalset_key": eval_key,
-                    "organ_label_dict": organ_label_dict
-                }
+
+        # each finetune task trains a list of organs, a single one unless packed
+        if PACKED_TRAINING:
+            splits = {split["organ"]: split for split in self.model_splits}
+            bins = pack_organs(
+                {organ: self._split_size(split) for organ, split in splits.items()},
+                PACKED_NUM_WORKERS,
             )
-        self.next(self.finetune, foreach="model_splits")
+            self.finetune_tasks = [[splits[organ] for organ in organs] for organs in bins]
+        else:
+            self.finetune_tasks = [[split] for split in self.model_splits]
+        self.next(self.finetune, foreach="finetune_tasks")
 
     @kubernetes(gpu=NUM_GPUS, cpu=NUM_CPUS, image=IMAGE)
+    @retry(times=FINETUNE_RETRIES)
     @step
     def finetune(self):
-        from datasets import load_from_disk
-        self.download(download_path=self.input["organ"] + "_trainset", store_key=self.input["organ_trainset_key"])
-        self.download(download_path=self.input["organ"] + "_evalset", store_key=self.input["organ_evalset_key"])
-        output_dir = self._finetune(
-            self.input["organ"],
-            load_from_disk(self.input["organ"] + "_trainset"),
-            load_from_disk(self.input["organ"] + "_evalset"),
-            self.input["organ_label_dict"],
+        # organs of a packed task share the pretrained weights loaded once here
+        backbone = self._load_backbone() if len(self.input) > 1 else None
+        self.chunk_stats = []
+        for i, split in enumerate(self.input):
+            print(f"Training organ {split['organ']} ({i + 1}/{len(self.input)})")
+            self._finetune_split(split, backbone)
+        self.next(self.join)
+
+    def _finetune_split(self, split, backbone=None):
+        import gc
+        import shutil
+        import torch
+
+        organ_trainset, organ_evalset = self._load_split(split)
+        finetune = self._finetune_distributed if DISTRIBUTED_TRAINING else self._finetune
+        output_dir = finetune(
+            split["organ"],
+            organ_trainset,
+            organ_evalset,
+            split["organ_label_dict"],
             MODEL_CHECKPOINT_DIR,
+            backbone=backbone,
+            # the same key on every attempt of this task, so a retry finds its checkpoints
+            checkpoint_store_key=os.path.join(DATA_KEY, str(current.run_id), "checkpoints", split["organ"]),
         )
-        self.upload(local_path=output_dir, store_key=os.path.join(DATA_KEY, str(current.run_id), output_dir))
-        self.next(self.join)   
+        chunk_stats_path = os.path.join(output_dir, "chunk_stats.json")
+        if os.path.exists(chunk_stats_path):
+            with open(chunk_stats_path) as f:
+                self.chunk_stats.append(json.load(f))
+        # checkpoints were uploaded while training, only the final model and results remain
+        self._upload_files(
+            [
+                (key, path)
+                for key, path in self._walk_directory(output_dir)
+                if not key.startswith("checkpoint-")
+            ],
+            store_key=os.path.join(DATA_KEY, str(current.run_id), output_dir),
+        )
+
+        # free the organ's data and GPU memory before the next organ of a packed task
+        if STREAM_TRAINING_DATA:
+            # stop the shard prefetchers and remove their cached shards
+            organ_trainset.close()
+            organ_evalset.close()
+        del organ_trainset, organ_evalset
+        if not STREAM_TRAINING_DATA:
+            shutil.rmtree(split["organ"] + "_trainset", ignore_errors=True)
+            shutil.rmtree(split["organ"] + "_evalset", ignore_errors=True)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
     @step
     def join(self, inputs):
-        self.next(self.end) 
+        chunk_stats = [stats for inp in inputs for stats in inp.chunk_stats]
+        if chunk_stats:
+            logical = sum(stats["logical_bytes"] for stats in chunk_stats)
+            uploaded = sum(stats["uploaded_bytes"] for stats in chunk_stats)
+            self.checkpoint_dedup_ratio = logical / uploaded if uploaded else float("inf")
+            print(
+                f"Checkpoints: {logical / 2**30:.2f}GB written, {uploaded / 2**30:.2f}GB uploaded, "
+                f"dedup ratio {self.checkpoint_dedup_ratio:.1f}x"
+            )
+        self.next(self.end)
 
     @step
     def end(self):
@@ -0,0 +1,89 @@
+from metaflow import FlowSpec, step, current
+import os
+import json
+from utils import DataStore, ModelOps
+from datastore import MANIFEST_NAME
+from config import *
+
+
+class CellClassificationHeads(FlowSpec, DataStore, ModelOps):
+    """
+    This workflow trains a classification head per organ on CPU, from the frozen-backbone
+    embeddings stored by embedding_flow.py, and reports the same metrics as finetuning.
+
+    Runs with different head settings only read the stored embeddings, the GPU is not used.
+    Head settings are set in config.py.
+    """
+
+    @step
+    def start(self):
+        self.model_splits, self.preprocess_cache_hit = self._load_model_splits(
+            os.path.join(DATA_KEY, DATA_DIR)
+        )
+        missing = [
+            split["organ"]
+            for split in self.model_splits
+            if not self.backend.exists(os.path.join(self._embeddings_key(split), MANIFEST_NAME))
+        ]
+        if missing:
+            raise ValueError(
+                f"No stored embeddings for {missing}, run embedding_flow.py first"
+            )
+        self.next(self.train_heads)
+
+    @step
+    def train_heads(self):
+        import time
+        import numpy as np
+        import torch
+        from transformers import EvalPrediction
+        from embeddings import train_head
+
+        self.head_metrics = {}
+        for split in self.model_splits:
+            organ = split["organ"]
+            embeddings_dir = f"{organ}_embeddings"
+            self.download(download_path=embeddings_dir, store_key=self._embeddings_key(split))
+
+            def load(name):
+                return np.load(os.path.join(embeddings_dir, name), mmap_mode="r")
+
+            start = time.time()
+            head, eval_logits = train_head(
+                load("train_embeddings.npy"),
+                load("train_labels.npy"),
+                load("eval_embeddings.npy"),
+                num_labels=len(split["organ_label_dict"]),
+            )
+            metrics = self.compute_metrics(
+                EvalPrediction(predictions=eval_logits, label_ids=np.asarray(load("eval_labels.npy")))
+            )
+            metrics = {f"eval_{name}": value for name, value in metrics.items()}
+            metrics["train_seconds"] = time.time() - start
+            self.head_metrics[organ] = metrics
+            print(f"{organ}: {metrics}")
+
+            output_dir = f"{organ}_head"
+            os.makedirs(output_dir, exist_ok=True)
+            torch.save(head.state_dict(), os.path.join(output_dir, "head.pt"))
+            with open(os.path.join(output_dir, "eval_results.json"), "w") as f:
+                json.dump(metrics, f, indent=2)
+            with open(os.path.join(output_dir, "label_dict.json"), "w") as f:
+                json.dump(split["organ_label_dict"], f)
+            self.upload(
+                local_path=output_dir,
+                store_key=os.path.join(DATA_KEY, str(current.run_id), "heads", organ),
+            )
+        self.next(self.end)
+
+    @step
+    def end(self):
+        for organ, metrics in self.head_metrics.items():
+            print(
+                f"{organ}: accuracy {metrics['eval_accuracy']:.3f}, "
+                f"macro F1 {metrics['eval_macro_f1']:.3f} in {metrics['train_seconds']:.1f}s"
+            )
+
+
+if __name__ == "__main__":
+    CellClassificationHeads()
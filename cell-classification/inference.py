@@ -0,0 +1,319 @@
+"""
+Batch inference with finetuned cell classifiers.
+
+Cells are scored in length-sorted batches packed up to a token budget, and predictions
+are written in Arrow shards. On CPU the model can run as a dynamically int8-quantized
+TorchScript or ONNX export; `--benchmark` compares cells/sec of each backend with
+eager PyTorch.
+
+    python inference.py --model-dir <finetuned output dir> --data <tokenized dataset> --output <dir>
+"""
+import os
+import json
+import time
+import argparse
+from config import *
+import modelstore
+
+BACKENDS = ("eager", "torchscript", "onnx")
+
+
+def load_classifier(model_dir, torchscript=False, pretrained_path=PRETRAINED_MODEL_PATH):
+    """
+    Finetuned classifier in eval mode, loaded through the model store. Models finetuned
+    with FINETUNE_MODE = "lora" only hold adapters and the head, which are composed onto
+    the pretrained model at pretrained_path and merged into its weights.
+    """
+    from transformers import BertForSequenceClassification
+
+    if not os.path.exists(os.path.join(model_dir, "adapter_config.json")):
+        model = modelstore.load_model(
+            BertForSequenceClassification, model_dir, torchscript=torchscript
+        )
+        return model.eval()
+
+    from peft import PeftModel
+
+    label_dict = read_label_dict(model_dir)
+    if label_dict is None:
+        raise FileNotFoundError(f"No label_dict.json in {model_dir}, needed to size the head")
+    base_model = modelstore.load_model(
+        BertForSequenceClassification,
+        pretrained_path,
+        num_labels=len(label_dict),
+        torchscript=torchscript,
+    )
+    model = PeftModel.from_pretrained(base_model, model_dir).merge_and_unload()
+    return model.eval()
+
+
+def read_label_dict(model_dir):
+    "Cell type : label id of a finetuned model, saved next to it by ModelOps._finetune."
+    path = os.path.join(model_dir, "label_dict.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _example_inputs(batch_size=2, length=128):
+    "Dummy input_ids and attention_mask, the last cell padded to half the length."
+    import torch
+
+    attention_mask = torch.ones(batch_size, length, dtype=torch.long)
+    attention_mask[-1, length // 2 :] = 0
+    return torch.ones(batch_size, length, dtype=torch.long), attention_mask
+
+
+def export_torchscript(model_dir, output_path, atol=1e-3):
+    """
+    Trace a dynamically int8-quantized copy of the classifier to a TorchScript file.
+    A trace can bake in the shapes it was traced with, so the traced model is checked
+    against the quantized model at other batch sizes and lengths before it is saved.
+    """
+    import torch
+
+    model = load_classifier(model_dir, torchscript=True)
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, _example_inputs(), strict=False)
+        for batch_size, length in [(1, 16), (5, 64), (3, model.config.max_position_embeddings)]:
+            inputs = _example_inputs(batch_size, length)
+            expected, actual = quantized(*inputs)[0], traced(*inputs)[0]
+            if expected.shape != actual.shape or not torch.allclose(expected, actual, atol=atol):
+                raise ValueError(
+                    f"TorchScript trace of {model_dir} does not match the model on "
+                    f"inputs of shape {(batch_size, length)}, use the eager or onnx backend"
+                )
+    torch.jit.save(traced, output_path)
+    return output_path
+
+
+def export_onnx(model_dir, output_path):
+    "Export the classifier to ONNX with dynamic batch and sequence axes, quantized to int8."
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    model = load_classifier(model_dir, torchscript=True)
+    float_path = f"{output_path}.float.onnx"
+    axes = {0: "batch", 1: "sequence"}
+    torch.onnx.export(
+        model,
+        _example_inputs(),
+        float_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={"input_ids": axes, "attention_mask": axes, "logits": {0: "batch"}},
+        opset_version=14,
+    )
+    quantize_dynamic(float_path, output_path, weight_type=QuantType.QInt8)
+    os.remove(float_path)
+    return output_path
+
+
+def load_runner(model_dir, backend="eager", export_dir=None, device="cpu"):
+    """
+    Parameters
+    ----------
+    model_dir : str
+        Directory of a finetuned model saved by ModelOps._finetune.
+    backend : str
+        "eager" runs the PyTorch model on device, "torchscript" and "onnx" run an int8
+        export on CPU.
+    export_dir : str
+        Where exports are written, defaults to model_dir.
+
+    Returns
+    -------
+    callable
+        Maps padded input_ids and attention_mask LongTensors to float32 logits.
+    """
+    import torch
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    export_dir = export_dir or model_dir
+
+    if backend == "eager":
+        model = load_classifier(model_dir).to(device)
+
+        def run(input_ids, attention_mask):
+            return model(
+                input_ids=input_ids.to(device), attention_mask=attention_mask.to(device)
+            ).logits.float().cpu()
+
+    elif backend == "torchscript":
+        model = torch.jit.load(
+            export_torchscript(model_dir, os.path.join(export_dir, "model.int8.pt"))
+        )
+
+        def run(input_ids, attention_mask):
+            return model(input_ids, attention_mask)[0].float()
+
+    else:
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(
+            export_onnx(model_dir, os.path.join(export_dir, "model.int8.onnx")),
+            providers=["CPUExecutionProvider"],
+        )
+
+        def run(input_ids, attention_mask):
+            (logits,) = session.run(
+                None,
+                {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()},
+            )
+            return torch.from_numpy(logits).float()
+
+    return run
+
+
+def iter_batches(dataset, max_tokens=INFERENCE_MAX_TOKENS_PER_BATCH, pad_token_id=0):
+    """
+    Yield (row indices, input_ids, attention_mask) for batches of similar-length cells,
+    longest first, each padded to its longest cell and within max_tokens padded tokens.
+    """
+    import torch
+    from training import TokenBudgetBatchSampler
+
+    sampler = TokenBudgetBatchSampler(dataset["length"], max_tokens, shuffle=False)
+    for rows in sampler:
+        cells = dataset[rows]["input_ids"]
+        longest = max(len(cell) for cell in cells)
+        input_ids = torch.full((len(cells), longest), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(cells), longest), dtype=torch.long)
+        for i, cell in enumerate(cells):
+            input_ids[i, : len(cell)] = torch.as_tensor(cell)
+            attention_mask[i, : len(cell)] = 1
+        yield rows, input_ids, attention_mask
+
+
+def _write_shard(path, rows, probs, indices, label_dict):
+    import numpy as np
+    import pyarrow as pa
+
+    k = indices.shape[1]
+    table = pa.table(
+        {
+            "row": pa.array(np.asarray(rows, dtype=np.int64)),
+            "prediction": pa.array(indices[:, 0].astype(np.int32)),
+            "top_k_labels": pa.FixedSizeListArray.from_arrays(
+                pa.array(indices.astype(np.int32).ravel()), k
+            ),
+            "top_k_probs": pa.FixedSizeListArray.from_arrays(
+                pa.array(probs.astype(np.float16).ravel()), k
+            ),
+        }
+    ).replace_schema_metadata({"label_dict": json.dumps(label_dict)})
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def predict_dataset(
+    run,
+    dataset,
+    output_dir,
+    label_dict=None,
+    max_tokens=INFERENCE_MAX_TOKENS_PER_BATCH,
+    rows_per_shard=INFERENCE_ROWS_PER_SHARD,
+    top_k=PREDICTIONS_TOP_K,
+    row_offset=0,
+):
+    """
+    Score every cell of a tokenized dataset and write predictions-XXXXX.arrow shards to
+    output_dir, with the dataset row (plus row_offset), the predicted label and the top k
+    labels and probabilities. Shards hold cells in length order, sort by row to restore
+    dataset order. Returns the number of cells scored per second.
+    """
+    import numpy as np
+    import torch
+
+    os.makedirs(output_dir, exist_ok=True)
+    buffered = {"rows": [], "probs": [], "indices": []}
+    num_shards = 0
+
+    def flush():
+        nonlocal num_shards
+        if not buffered["rows"]:
+            return
+        _write_shard(
+            os.path.join(output_dir, f"predictions-{num_shards:05d}.arrow"),
+            np.concatenate(buffered["rows"]) + row_offset,
+            np.concatenate(buffered["probs"]),
+            np.concatenate(buffered["indices"]),
+            label_dict or {},
+        )
+        num_shards += 1
+        for values in buffered.values():
+            values.clear()
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for rows, input_ids, attention_mask in iter_batches(dataset, max_tokens):
+            logits = run(input_ids, attention_mask)
+            probs, indices = torch.softmax(logits, dim=-1).topk(min(top_k, logits.shape[-1]))
+            buffered["rows"].append(np.asarray(rows))
+            buffered["probs"].append(probs.half().numpy())
+            buffered["indices"].append(indices.numpy())
+            if sum(len(rows) for rows in buffered["rows"]) >= rows_per_shard:
+                flush()
+    flush()
+    return len(dataset) / (time.perf_counter() - start)
+
+
+def benchmark(model_dir, dataset, backends=BACKENDS, num_cells=INFERENCE_BENCHMARK_CELLS):
+    """
+    Cells/sec of each backend on the first num_cells cells, on CPU.
+    Backends whose dependencies are missing are reported as None.
+    """
+    from tempfile import TemporaryDirectory
+
+    subset = dataset.select(range(min(num_cells, len(dataset))))
+    results = {}
+    with TemporaryDirectory() as export_dir:
+        for backend in backends:
+            try:
+                run = load_runner(model_dir, backend, export_dir=export_dir)
+            except ImportError as e:
+                print(f"Skipping {backend}: {e}")
+                results[backend] = None
+                continue
+            results[backend] = predict_dataset(
+                run, subset, os.path.join(export_dir, f"{backend}-predictions")
+            )
+            print(f"{backend}: {results[backend]:.1f} cells/sec")
+    return results
+
+
+def main():
+    from datasets import load_from_disk
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model-dir", required=True, help="finetuned model directory")
+    parser.add_argument("--data", required=True, help="tokenized dataset saved with save_to_disk")
+    parser.add_argument("--output", default="predictions", help="directory of prediction shards")
+    parser.add_argument("--backend", choices=BACKENDS, default=INFERENCE_BACKEND)
+    parser.add_argument("--max-tokens", type=int, default=INFERENCE_MAX_TOKENS_PER_BATCH)
+    parser.add_argument("--benchmark", action="store_true", help="compare cells/sec of every backend")
+    args = parser.parse_args()
+
+    dataset = load_from_disk(args.data)
+    if args.benchmark:
+        print(json.dumps(benchmark(args.model_dir, dataset), indent=2))
+        return
+    run = load_runner(args.model_dir, args.backend)
+    cells_per_second = predict_dataset(
+        run,
+        dataset,
+        args.output,
+        label_dict=read_label_dict(args.model_dir),
+        max_tokens=args.max_tokens,
+    )
+    print(f"Scored {len(dataset)} cells at {cells_per_second:.1f} cells/sec")
+
+
+if __name__ == "__main__":
+    main()
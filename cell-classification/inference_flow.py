@@ -0,0 +1,129 @@
+from metaflow import FlowSpec, Parameter, step, kubernetes, current
+import os
+from utils import DataStore
+from config import *
+
+
+class CellClassificationInference(FlowSpec, DataStore):
+    """
+    This workflow scores tokenized cells with a cell classifier finetuned by flow.py.
+
+    The dataset is split into INFERENCE_TASKS contiguous row ranges scored in parallel on
+    CPU nodes, each task fetching only the Arrow shards of its range, and predictions are
+    written in Arrow shards under output_key/<task>.
+    Datasets not stored with DataStore.upload_hf_dataset are re-stored with it once first.
+    Inference settings are set in config.py.
+    """
+
+    model_key = Parameter(
+        "model_key",
+        help="Datastore key of a finetuned model directory, e.g. <DATA_KEY>/<run id>/<output dir>",
+        required=True,
+    )
+    data_key = Parameter(
+        "data_key",
+        help="Datastore key of a tokenized dataset saved with save_to_disk",
+        required=True,
+    )
+    output_key = Parameter(
+        "output_key",
+        help="Datastore key the prediction shards are written under, defaults to <DATA_KEY>/predictions/<run id>",
+        default="",
+    )
+    backend = Parameter(
+        "backend", help="eager, torchscript or onnx", default=INFERENCE_BACKEND
+    )
+    benchmark = Parameter(
+        "benchmark",
+        help="Time every backend on INFERENCE_BENCHMARK_CELLS cells before scoring",
+        default=False,
+        type=bool,
+    )
+
+    @step
+    def start(self):
+        self.predictions_key = self.output_key or os.path.join(
+            DATA_KEY, "predictions", str(current.run_id)
+        )
+        self.shards_key = self.data_key
+        shards = self._hf_shards(self.data_key)
+        if shards is None:
+            # without per-shard row counts every task would download the whole dataset,
+            # so download it once here and store it in shards the tasks can pick from
+            from datasets import load_from_disk
+
+            self.download(download_path="data.dataset", store_key=self.data_key)
+            self.shards_key = os.path.join(DATA_KEY, "inference_inputs", str(current.run_id))
+            self.upload_hf_dataset(load_from_disk("data.dataset"), store_key=self.shards_key)
+            shards = self._hf_shards(self.shards_key)
+
+        # the contiguous ranges Dataset.shard would assign, empty ones dropped
+        num_rows = sum(info["num_rows"] for _, info in shards)
+        self.tasks = []
+        for task in range(INFERENCE_TASKS):
+            start = num_rows // INFERENCE_TASKS * task + min(task, num_rows % INFERENCE_TASKS)
+            stop = start + num_rows // INFERENCE_TASKS + (task < num_rows % INFERENCE_TASKS)
+            if stop > start:
+                self.tasks.append({"task": task, "start": start, "stop": stop})
+        self.next(self.predict, foreach="tasks")
+
+    @kubernetes(cpu=NUM_CPUS, image=IMAGE)
+    @step
+    def predict(self):
+        from inference import (
+            benchmark,
+            load_runner,
+            predict_dataset,
+            read_label_dict,
+        )
+
+        self.download(download_path="model", store_key=self.model_key)
+        task = self.input["task"]
+        dataset = self.download_hf_dataset_rows(
+            "data.dataset",
+            start=self.input["start"],
+            stop=self.input["stop"],
+            store_key=self.shards_key,
+        )
+
+        if self.benchmark and task == 0:
+            self.benchmark_results = benchmark("model", dataset)
+        self.cells_per_second = predict_dataset(
+            load_runner("model", self.backend),
+            dataset,
+            "predictions",
+            label_dict=read_label_dict("model"),
+            row_offset=self.input["start"],
+        )
+        self.num_cells = len(dataset)
+        print(f"Scored {self.num_cells} cells at {self.cells_per_second:.1f} cells/sec")
+        self.upload(
+            local_path="predictions",
+            store_key=os.path.join(self.predictions_key, f"{task:05d}"),
+        )
+        self.next(self.join)
+
+    @step
+    def join(self, inputs):
+        self.predictions_key = inputs[0].predictions_key
+        self.num_tasks = len(inputs)
+        self.num_cells = sum(inp.num_cells for inp in inputs)
+        self.cells_per_second = sum(inp.cells_per_second for inp in inputs)
+        self.benchmark_results = next(
+            (inp.benchmark_results for inp in inputs if hasattr(inp, "benchmark_results")),
+            None,
+        )
+        self.next(self.end)
+
+    @step
+    def end(self):
+        print(
+            f"Scored {self.num_cells} cells at {self.cells_per_second:.1f} cells/sec "
+            f"across {self.num_tasks} tasks, predictions in {self._url(self.predictions_key)}"
+        )
+        if self.benchmark_results:
+            print(f"Benchmark (cells/sec): {self.benchmark_results}")
+
+
+if __name__ == "__main__":
+    CellClassificationInference()
@@ -0,0 +1 @@
+../modelstore.py
\ No newline at end of file
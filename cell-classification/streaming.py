@@ -0,0 +1,163 @@
+import os
+import bisect
+import random
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+
+import torch
+from config import *
+from datastore import DataStore
+
+
+class StreamingArrowDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset over the Arrow shards of a dataset stored with
+    `DataStore.upload_hf_dataset`, fetching shards on demand.
+
+    Shards are downloaded in the background ahead of the reader and kept in a bounded
+    local cache, so training can start as soon as the first shard has arrived.
+    Row counts come from the upload manifest, nothing is fetched up front.
+    Random access across shards thrashes the cache; iterate with ShardGroupedSampler.
+    """
+
+    def __init__(
+        self,
+        store_key,
+        datastore=None,
+        cache_dir=None,
+        prefetch_shards=STREAM_PREFETCH_SHARDS,
+        max_cached_shards=STREAM_CACHE_SHARDS,
+    ):
+        self.store_key = store_key
+        self._datastore = datastore if datastore is not None else DataStore()
+        manifest = self._datastore._read_manifest(store_key)
+        if manifest is None:
+            raise ValueError(
+                f"No manifest found for {store_key}, upload it with DataStore.upload_hf_dataset"
+            )
+        self._files = manifest["files"]
+        self.shards = sorted(
+            name for name, info in self._files.items() if "num_rows" in info
+        )
+        self._offsets = [0]
+        for name in self.shards:
+            self._offsets.append(self._offsets[-1] + self._files[name]["num_rows"])
+        self._cache_dir = cache_dir or mkdtemp(prefix="streaming-shards-")
+        self._prefetch_shards = prefetch_shards
+        self._max_cached_shards = max(max_cached_shards, 1)
+        self._pool = ThreadPoolExecutor(max(prefetch_shards, 1))
+        self._lock = threading.Lock()
+        self._downloads = {}
+        self._tables = OrderedDict()
+        self._shard_order = list(range(len(self.shards)))
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def shard_rows(self, shard_idx):
+        "Range of dataset indices stored in a shard."
+        return range(self._offsets[shard_idx], self._offsets[shard_idx + 1])
+
+    def set_shard_order(self, shard_order):
+        "Tell the prefetcher which shard follows which, e.g. for a shuffled epoch."
+        self._shard_order = list(shard_order)
+        for shard_idx in self._shard_order[: self._prefetch_shards]:
+            self._schedule(shard_idx)
+
+    def _shard_path(self, shard_idx):
+        return os.path.join(self._cache_dir, self.shards[shard_idx])
+
+    def _schedule(self, shard_idx):
+        with self._lock:
+            if shard_idx in self._tables or shard_idx in self._downloads:
+                return self._downloads.get(shard_idx)
+            name = self.shards[shard_idx]
+            self._downloads[shard_idx] = self._pool.submit(
+                self._datastore._fetch_objects,
+                self.store_key,
+                [(name, self._files[name])],
+                lambda key, info: self._shard_path(shard_idx),
+            )
+            return self._downloads[shard_idx]
+
+    def _prefetch_after(self, shard_idx):
+        position = self._shard_order.index(shard_idx)
+        for next_idx in self._shard_order[position + 1 : position + 1 + self._prefetch_shards]:
+            self._schedule(next_idx)
+
+    def _table(self, shard_idx):
+        import pyarrow as pa
+
+        with self._lock:
+            if shard_idx in self._tables:
+                self._tables.move_to_end(shard_idx)
+                return self._tables[shard_idx]
+        future = self._schedule(shard_idx)
+        if future is None:
+            # loaded by another reader in the meantime
+            return self._table(shard_idx)
+        future.result()
+        self._prefetch_after(shard_idx)
+        # shards are Arrow IPC streams, memory-mapping them keeps the read zero-copy
+        table = pa.ipc.open_stream(pa.memory_map(self._shard_path(shard_idx))).read_all()
+        with self._lock:
+            self._downloads.pop(shard_idx, None)
+            self._tables[shard_idx] = table
+            while len(self._tables) > self._max_cached_shards:
+                evicted_idx, _ = self._tables.popitem(last=False)
+                os.remove(self._shard_path(evicted_idx))
+        return table
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard_idx = bisect.bisect_right(self._offsets, idx) - 1
+        table = self._table(shard_idx)
+        return table.slice(idx - self._offsets[shard_idx], 1).to_pylist()[0]
+
+    def __reduce__(self):
+        # sent to another process, e.g. a distributed worker, as a fresh reader with its own cache
+        return (
+            StreamingArrowDataset,
+            (self.store_key, None, None, self._prefetch_shards, self._max_cached_shards),
+        )
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self._tables.clear()
+        shutil.rmtree(self._cache_dir, ignore_errors=True)
+
+
+class ShardGroupedSampler(torch.utils.data.Sampler):
+    """
+    Shuffle the shard order and the rows within each shard, reading one shard at a time.
+    Every epoch draws a new order and hands it to the dataset's prefetcher.
+    """
+
+    def __init__(self, dataset, shuffle=True, seed=42):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        shard_order = list(range(len(self.dataset.shards)))
+        if self.shuffle:
+            rng.shuffle(shard_order)
+        self.dataset.set_shard_order(shard_order)
+        self.epoch += 1
+        for shard_idx in shard_order:
+            rows = list(self.dataset.shard_rows(shard_idx))
+            if self.shuffle:
+                rng.shuffle(rows)
+            yield from rows
@@ -0,0 +1,133 @@
+from metaflow import FlowSpec, step, kubernetes, current
+import os
+import math
+import json
+from utils import DataStore, ModelOps
+from config import *
+
+
+class CellClassificationSweep(FlowSpec, DataStore, ModelOps):
+    """
+    This workflow searches finetuning hyperparameters with successive halving.
+
+    SWEEP_NUM_TRIALS hyperparameter sets are sampled from SWEEP_SPACE with hyperopt and
+    trained on one organ for SWEEP_RUNG_EPOCHS[0] epochs. The best 1/SWEEP_ETA of the trials
+    by SWEEP_METRIC are promoted to the next rung, where they resume from their checkpoint
+    and train up to the rung's epochs, and the others stop there.
+    All trials read the same stored organ splits as flow.py, built once per input dataset.
+
+    Sweep settings are set in config.py.
+    """
+
+    @step
+    def start(self):
+        from utils import sample_trials
+
+        self.model_splits, self.preprocess_cache_hit = self._load_model_splits(
+            os.path.join(DATA_KEY, DATA_DIR)
+        )
+        if SWEEP_ORGAN is None:
+            self.split = max(self.model_splits, key=self._split_size)
+        else:
+            self.split = next(s for s in self.model_splits if s["organ"] == SWEEP_ORGAN)
+        print(f"Sweeping on organ {self.split['organ']}")
+
+        self.trials = [
+            {"trial_id": i, "hyperparameters": hyperparameters}
+            for i, hyperparameters in enumerate(sample_trials())
+        ]
+        self.results = []
+        self.next(self.rung_0, foreach="trials")
+
+    def _train_trial(self, rung):
+        "Train the input trial up to the rung's epochs and record its eval metrics."
+        import shutil
+
+        self.trial = dict(self.input, rung=rung)
+        organ_trainset, organ_evalset = self._load_split(self.split)
+        output_dir = self._finetune(
+            self.split["organ"],
+            organ_trainset,
+            organ_evalset,
+            self.split["organ_label_dict"],
+            os.path.join(MODEL_CHECKPOINT_DIR, f"trial_{self.trial['trial_id']}"),
+            # a trial's checkpoints are kept across rungs, promoted trials resume from them
+            checkpoint_store_key=os.path.join(
+                DATA_KEY, str(current.run_id), "sweep", f"trial_{self.trial['trial_id']}"
+            ),
+            hyperparameters=dict(
+                self.trial["hyperparameters"], epochs=SWEEP_RUNG_EPOCHS[rung]
+            ),
+        )
+        with open(os.path.join(output_dir, "eval_results.json")) as f:
+            self.trial["metrics"] = json.load(f)
+        self.trial["score"] = self.trial["metrics"][SWEEP_METRIC]
+        print(f"Trial {self.trial['trial_id']} rung {rung}: {SWEEP_METRIC}={self.trial['score']}")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if STREAM_TRAINING_DATA:
+            organ_trainset.close()
+            organ_evalset.close()
+
+    def _promote(self, inputs):
+        "Record the rung's results and keep its best 1/SWEEP_ETA trials."
+        self.merge_artifacts(inputs, include=["split", "results"])
+        ranked = sorted((inp.trial for inp in inputs), key=lambda t: t["score"], reverse=True)
+        self.results = self.results + ranked
+        self.trials = ranked[: max(1, math.ceil(len(ranked) / SWEEP_ETA))]
+        print(
+            f"Rung {ranked[0]['rung']}: promoting trials "
+            f"{[t['trial_id'] for t in self.trials]} of {len(ranked)}"
+        )
+
+    @kubernetes(gpu=NUM_GPUS, cpu=NUM_CPUS, image=IMAGE)
+    @step
+    def rung_0(self):
+        self._train_trial(0)
+        self.next(self.promote_0)
+
+    @step
+    def promote_0(self, inputs):
+        self._promote(inputs)
+        self.next(self.rung_1, foreach="trials")
+
+    @kubernetes(gpu=NUM_GPUS, cpu=NUM_CPUS, image=IMAGE)
+    @step
+    def rung_1(self):
+        self._train_trial(1)
+        self.next(self.promote_1)
+
+    @step
+    def promote_1(self, inputs):
+        self._promote(inputs)
+        self.next(self.rung_2, foreach="trials")
+
+    @kubernetes(gpu=NUM_GPUS, cpu=NUM_CPUS, image=IMAGE)
+    @step
+    def rung_2(self):
+        self._train_trial(2)
+        self.next(self.promote_2)
+
+    @step
+    def promote_2(self, inputs):
+        self._promote(inputs)
+        self.best_trial = self.trials[0]
+        self.next(self.end)
+
+    @step
+    def end(self):
+        epochs = sum(
+            SWEEP_RUNG_EPOCHS[t["rung"]] - (SWEEP_RUNG_EPOCHS[t["rung"] - 1] if t["rung"] else 0)
+            for t in self.results
+        )
+        print(
+            f"Best trial {self.best_trial['trial_id']}: {SWEEP_METRIC}={self.best_trial['score']} "
+            f"with {self.best_trial['hyperparameters']}"
+        )
+        print(
+            f"Trained {epochs} epochs in total, a grid of the same trials at "
+            f"{SWEEP_RUNG_EPOCHS[-1]} epochs trains {SWEEP_NUM_TRIALS * SWEEP_RUNG_EPOCHS[-1]}"
+        )
+
+
+if __name__ == "__main__":
+    CellClassificationSweep()
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+# the flow modules import each other and config.py from the flow directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def store(tmp_path):
+    "DataStore with the ModelOps of the flows, on a LocalBackend in a temporary directory."
+    from utils import DataStore, ModelOps
+
+    class Store(DataStore, ModelOps):
+        pass
+
+    datastore = Store()
+    datastore._store_root = str(tmp_path / "store")
+    return datastore
+
+
+@pytest.fixture
+def organ_cells():
+    "Tokenized cells of three organs, bone marrow merged into immune as in ORGAN_MERGE."
+    import numpy as np
+
+    datasets = pytest.importorskip("datasets")
+    rng = np.random.default_rng(0)
+    organs = ["immune"] * 200 + ["bone_marrow"] * 50 + ["lung"] * 250 + ["kidney"] * 100
+    cell_types = [f"{organ}_{rng.integers(0, 4)}" for organ in organs]
+    # a cell type rarer than RARE_CELL_TYPE_FRACTION, dropped from the lung split
+    cell_types[-101] = "lung_rare"
+    lengths = rng.integers(2, 20, len(organs))
+    return datasets.Dataset.from_dict(
+        {
+            "input_ids": [rng.integers(1, 100, length).tolist() for length in lengths],
+            "length": lengths.tolist(),
+            "organ_major": organs,
+            "cell_type": cell_types,
+        }
+    )
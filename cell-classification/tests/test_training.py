@@ -0,0 +1,204 @@
+import os
+import socket
+import datetime
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+torch = pytest.importorskip("torch")
+datasets = pytest.importorskip("datasets")
+transformers = pytest.importorskip("transformers")
+
+from training import (
+    BestEvalOutputs,
+    CellClassificationTrainer,
+    TokenBudgetBatchSampler,
+    save_predictions,
+    top_k_predictions,
+)
+
+NUM_LABELS = 3
+
+
+def tiny_classifier(seed=0):
+    torch.manual_seed(seed)
+    config = transformers.BertConfig(
+        vocab_size=32,
+        hidden_size=16,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=32,
+        max_position_embeddings=64,
+        num_labels=NUM_LABELS,
+    )
+    return transformers.BertForSequenceClassification(config)
+
+
+def cells(num_cells, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(2, 40, num_cells)
+    return datasets.Dataset.from_dict(
+        {
+            "input_ids": [rng.integers(1, 32, length).tolist() for length in lengths],
+            "length": lengths.tolist(),
+            "label": rng.integers(0, NUM_LABELS, num_cells).tolist(),
+        }
+    )
+
+
+def collate(features):
+    "Pad input_ids to the longest cell of the batch, like DataCollatorForCellClassification."
+    longest = max(len(feature["input_ids"]) for feature in features)
+    input_ids = torch.zeros(len(features), longest, dtype=torch.long)
+    attention_mask = torch.zeros(len(features), longest, dtype=torch.long)
+    for i, feature in enumerate(features):
+        input_ids[i, : len(feature["input_ids"])] = torch.as_tensor(feature["input_ids"])
+        attention_mask[i, : len(feature["input_ids"])] = 1
+    labels = torch.tensor([feature["label"] for feature in features])
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def accuracy(pred):
+    return {"accuracy": float((pred.predictions[1][:, 0] == pred.label_ids).mean())}
+
+
+def make_trainer(output_dir, trainset, evalset, best_eval, max_tokens=64, **kwargs):
+    args = {
+        "output_dir": output_dir,
+        "evaluation_strategy": "epoch",
+        "save_strategy": "epoch",
+        "num_train_epochs": 1,
+        "per_device_train_batch_size": 4,
+        "per_device_eval_batch_size": 4,
+        "load_best_model_at_end": True,
+        "length_column_name": "length",
+        "save_safetensors": True,
+        "report_to": [],
+        "use_cpu": True,
+        **kwargs,
+    }
+    return CellClassificationTrainer(
+        model=tiny_classifier(),
+        args=transformers.TrainingArguments(**args),
+        data_collator=collate,
+        train_dataset=trainset,
+        eval_dataset=evalset,
+        compute_metrics=best_eval.compute_metrics,
+        preprocess_logits_for_metrics=top_k_predictions(2),
+        max_tokens_per_batch=max_tokens,
+        callbacks=[best_eval],
+    )
+
+
+def test_token_budget_batches_cover_every_cell_within_budget():
+    lengths = np.random.default_rng(0).integers(1, 100, 500)
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=256, shuffle=False)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert lengths[batch].max() * len(batch) <= 256
+    # longest batches first, with similar lengths packed together
+    assert lengths[batches[0][0]] == lengths.max()
+
+
+def test_token_budget_long_cell_gets_its_own_batch():
+    sampler = TokenBudgetBatchSampler([10, 300, 10], max_tokens=100, shuffle=False)
+    assert list(sampler) == [[1], [0, 2]]
+
+
+def test_token_budget_shuffle_keeps_batches_and_reorders_per_epoch():
+    lengths = np.random.default_rng(1).integers(1, 50, 200)
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=128, seed=3)
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    assert sorted(map(tuple, first)) == sorted(map(tuple, second))
+    sampler.set_epoch(0)
+    assert list(sampler) == first
+    assert len(first) == len(sampler)
+
+
+def read_predictions(output_dir):
+    with pa.memory_map(os.path.join(output_dir, "predictions.arrow")) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+@pytest.mark.parametrize("max_tokens", [64, None])
+def test_predictions_line_up_with_eval_rows_on_resume(tmp_path, max_tokens):
+    trainset, evalset = cells(32, seed=0), cells(24, seed=1)
+    output_dir = str(tmp_path)
+    make_trainer(output_dir, trainset, evalset, BestEvalOutputs(accuracy), max_tokens).train()
+    (checkpoint,) = [name for name in os.listdir(output_dir) if name.startswith("checkpoint-")]
+
+    # a retry resuming from the final checkpoint trains no further and evaluates nothing,
+    # so its predictions come from the predict fallback of ModelOps._finetune
+    best_eval = BestEvalOutputs(accuracy)
+    trainer = make_trainer(output_dir, trainset, evalset, best_eval, max_tokens)
+    trainer.train(resume_from_checkpoint=os.path.join(output_dir, checkpoint))
+    assert best_eval.predictions is None
+    output = trainer.predict(evalset, metric_key_prefix="eval")
+    save_predictions(output_dir, output, {"a": 0, "b": 1, "c": 2}, rows=trainer.eval_rows(evalset))
+
+    table = read_predictions(output_dir)
+    rows = table["row"].to_numpy()
+    assert sorted(rows) == list(range(len(evalset)))
+    assert table["label"].to_pylist() == [evalset[int(row)]["label"] for row in rows]
+
+
+def test_token_budget_eval_loss_is_the_mean_over_cells(tmp_path):
+    evalset = cells(40, seed=2)
+    losses = {}
+    for max_tokens in (64, None):
+        trainer = make_trainer(
+            str(tmp_path), evalset, evalset, BestEvalOutputs(accuracy), max_tokens,
+            per_device_eval_batch_size=1,
+        )
+        losses[max_tokens] = trainer.evaluate()["eval_loss"]
+    # one cell per batch without the token budget, so that loss is the mean over cells
+    assert losses[64] == pytest.approx(losses[None], abs=1e-5)
+
+
+def _predict_distributed(rank, world_size, port, output_dir):
+    import torch.distributed as dist
+
+    os.environ.update(
+        {
+            "MASTER_ADDR": "127.0.0.1",
+            "MASTER_PORT": str(port),
+            "RANK": str(rank),
+            "LOCAL_RANK": str(rank),
+            "WORLD_SIZE": str(world_size),
+        }
+    )
+    # a collective that never completes fails the test instead of hanging it
+    dist.init_process_group(
+        "gloo", rank=rank, world_size=world_size, timeout=datetime.timedelta(seconds=60)
+    )
+    try:
+        evalset = cells(23, seed=1)
+        trainer = make_trainer(
+            output_dir, evalset, evalset, BestEvalOutputs(accuracy), 64, ddp_backend="gloo"
+        )
+        assert "eval_accuracy" in trainer.evaluate()
+        output = trainer.predict(evalset, metric_key_prefix="eval")
+        if trainer.is_world_process_zero():
+            save_predictions(
+                output_dir, output, {"a": 0, "b": 1, "c": 2}, rows=trainer.eval_rows(evalset)
+            )
+    finally:
+        dist.destroy_process_group()
+
+
+def test_token_budget_eval_under_gloo_ddp(tmp_path):
+    import torch.multiprocessing as mp
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    mp.spawn(_predict_distributed, args=(2, port, str(tmp_path)), nprocs=2, join=True)
+
+    evalset = cells(23, seed=1)
+    table = read_predictions(str(tmp_path))
+    rows = table["row"].to_numpy()
+    assert sorted(rows) == list(range(len(evalset)))
+    assert table["label"].to_pylist() == [evalset[int(row)]["label"] for row in rows]
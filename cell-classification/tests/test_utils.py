@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+import utils
+from config import DATA_KEY
+
+
+def store_dataset(store, dataset, tmp_path, key="input.dataset"):
+    dataset.save_to_disk(str(tmp_path / "local.dataset"))
+    store.upload(str(tmp_path / "local.dataset"), key)
+    return key
+
+
+def test_disabled_preprocess_cache_leaves_cached_splits_alone(
+    tmp_path, store, organ_cells, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    data_key = store_dataset(store, organ_cells, tmp_path)
+
+    splits, reused = store._load_model_splits(data_key)
+    assert not reused
+    assert store._load_model_splits(data_key) == (splits, True)
+    cache_key = os.path.dirname(splits[0]["organ_trainset_key"])
+    cached_manifest = store._read_manifest(splits[0]["organ_trainset_key"])
+
+    monkeypatch.setattr(utils, "PREPROCESS_CACHE", False)
+    uncached, reused = store._load_model_splits(data_key)
+    assert not reused
+    assert os.path.dirname(uncached[0]["organ_trainset_key"]) != cache_key
+    assert os.path.dirname(uncached[0]["organ_trainset_key"]).startswith(
+        os.path.join(DATA_KEY, "preprocessed")
+    )
+    # the cached splits were neither rewritten nor replaced
+    assert store._read_manifest(splits[0]["organ_trainset_key"]) == cached_manifest
+    assert store.get_json(os.path.join(cache_key, "model_splits.json")) == splits
+
+
+def filter_shuffle_split(dataset, organ, seed, train_fraction):
+    "The per-organ filter, rare cell type pruning, shuffle and split partition_organs replaces."
+    from collections import Counter
+
+    merged = [o for o, into in utils.ORGAN_MERGE.items() if into == organ]
+    organ_dataset = dataset.add_column("row", list(range(len(dataset)))).filter(
+        lambda example: example["organ_major"] in [organ, *merged]
+    )
+    counts = Counter(organ_dataset["cell_type"])
+    total = sum(counts.values())
+    organ_dataset = organ_dataset.filter(
+        lambda example: counts[example["cell_type"]] > utils.RARE_CELL_TYPE_FRACTION * total
+    ).shuffle(seed=seed)
+    num_train = round(len(organ_dataset) * train_fraction)
+    return organ_dataset["row"][:num_train], organ_dataset["row"][num_train:]
+
+
+@pytest.mark.parametrize("stratified", [True, False])
+def test_partition_organs_merges_prunes_and_splits(organ_cells, stratified):
+    partitions = utils.partition_organs(organ_cells, stratified=stratified)
+    assert [partition["organ"] for partition in partitions] == ["immune", "lung", "kidney"]
+
+    organs = organ_cells["organ_major"]
+    cell_types = organ_cells["cell_type"]
+    for partition in partitions:
+        train, evaluate = partition["train_indices"], partition["eval_indices"]
+        assert not set(train) & set(evaluate)
+        assert {organs[row] for row in [*train, *evaluate]} <= (
+            {"immune", "bone_marrow"} if partition["organ"] == "immune" else {partition["organ"]}
+        )
+        assert "lung_rare" not in partition["label_dict"]
+        # every eval label is trained on, and label ids agree with the label dict
+        assert set(partition["eval_labels"]) <= set(partition["train_labels"])
+        label_dict = partition["label_dict"]
+        assert [label_dict[cell_types[row]] for row in train] == list(partition["train_labels"])
+        assert [label_dict[cell_types[row]] for row in evaluate] == list(partition["eval_labels"])
+
+    immune = partitions[0]
+    assert len(immune["train_indices"]) + len(immune["eval_indices"]) == 250
+    assert any(organs[row] == "bone_marrow" for row in immune["train_indices"])
+
+
+def test_partition_organs_matches_filter_shuffle_split(organ_cells):
+    partitions = utils.partition_organs(organ_cells, seed=3, train_fraction=0.7, stratified=False)
+    for partition in partitions:
+        train, evaluate = filter_shuffle_split(organ_cells, partition["organ"], 3, 0.7)
+        assert list(partition["train_indices"]) == train
+        # eval keeps the cell types seen in training, all of them in these organs
+        assert list(partition["eval_indices"]) == evaluate
+
+
+def test_stratified_split_keeps_the_train_fraction_of_every_cell_type(organ_cells):
+    from collections import Counter
+
+    for partition in utils.partition_organs(organ_cells, train_fraction=0.8, stratified=True):
+        train = Counter(partition["train_labels"].tolist())
+        total = train + Counter(partition["eval_labels"].tolist())
+        for label, count in total.items():
+            assert train[label] == max(1, int(count * 0.8 + 0.5))
@@ -0,0 +1,392 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from transformers import Trainer, TrainerCallback
+from transformers.trainer_pt_utils import find_batch_size
+from streaming import StreamingArrowDataset, ShardGroupedSampler
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of dataset indices whose padded size, batch size x longest cell, stays within
+    max_tokens. Cells are packed in order of decreasing length, so short cells train many
+    per step and long cells still fit. Batch composition is fixed, only the order of the
+    batches is reshuffled every epoch, which keeps the number of steps per epoch constant.
+    A cell longer than max_tokens gets a batch of its own.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=42):
+        import numpy as np
+
+        lengths = np.asarray(lengths)
+        self.batches = []
+        batch = []
+        for idx in np.argsort(-lengths, kind="stable"):
+            # the first cell of a batch is its longest
+            if batch and lengths[batch[0]] * (len(batch) + 1) > max_tokens:
+                self.batches.append(batch)
+                batch = []
+            batch.append(int(idx))
+        if batch:
+            self.batches.append(batch)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = torch.arange(len(self.batches))
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.batches), generator=generator)
+        self.epoch += 1
+        for i in order.tolist():
+            yield self.batches[i]
+
+
+class PaddingStatsCollator:
+    """
+    Wraps a collator and counts the real and padded tokens of the batches it builds.
+    Counts are kept in the calling process, so use it with dataloader_num_workers=0.
+    """
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.reset()
+
+    def reset(self):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def __call__(self, features):
+        batch = self.collator(features)
+        self.real_tokens += sum(len(feature["input_ids"]) for feature in features)
+        self.padded_tokens += batch["input_ids"].numel()
+        return batch
+
+
+def freeze_backbone(model, freeze_embeddings, num_layers):
+    """
+    Stop gradients to the embeddings and the first num_layers encoder layers of a BERT model.
+    Returns the number of frozen parameters.
+    """
+    modules = list(model.bert.encoder.layer[:num_layers])
+    if freeze_embeddings:
+        modules.append(model.bert.embeddings)
+    frozen = 0
+    for module in modules:
+        for param in module.parameters():
+            param.requires_grad = False
+            frozen += param.numel()
+    return frozen
+
+
+def mixed_precision_args(mode):
+    "TrainingArguments precision flags for a profile's mixed_precision setting."
+    if mode is None or not torch.cuda.is_available():
+        return {}
+    if mode == "auto":
+        mode = "bf16" if torch.cuda.is_bf16_supported() else "fp16"
+    return {mode: True}
+
+
+class ProfileCallback(TrainerCallback):
+    "Measures optimizer step time and peak GPU memory over a training run."
+
+    def __init__(self):
+        self.step_times = []
+        self._step_start = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.step_times.append(time.perf_counter() - self._step_start)
+
+    def results(self):
+        # the first step includes cuda initialization and allocator warmup
+        times = self.step_times[1:] or self.step_times
+        results = {
+            "mean_step_seconds": sum(times) / len(times) if times else None,
+            "steps": len(self.step_times),
+        }
+        if torch.cuda.is_available():
+            results["peak_memory_gb"] = torch.cuda.max_memory_allocated() / 1e9
+        return results
+
+
+def top_k_predictions(k, keep_logits=False):
+    """
+    preprocess_logits_for_metrics reducing every cell's logits to its top k probabilities
+    (float16) and labels before they are accumulated, so eval memory does not grow with
+    the number of classes. With keep_logits the float16 logits are kept as well.
+    """
+
+    def preprocess_logits_for_metrics(logits, labels):
+        probs, indices = torch.softmax(logits.float(), dim=-1).topk(min(k, logits.shape[-1]))
+        outputs = (probs.half(), indices)
+        if keep_logits:
+            outputs += (logits.half(),)
+        return outputs
+
+    return preprocess_logits_for_metrics
+
+
+class BestEvalOutputs(TrainerCallback):
+    """
+    Keep the predictions and metrics of the best evaluation, by the Trainer's
+    metric_for_best_model, so the best model's eval outputs need no second prediction pass.
+    Pass its compute_metrics to the Trainer in place of the wrapped one.
+    """
+
+    def __init__(self, compute_metrics):
+        self._compute_metrics = compute_metrics
+        self._latest = None
+        self._best = None
+        self.predictions = None
+        self.metrics = None
+
+    def compute_metrics(self, pred):
+        self._latest = pred
+        return self._compute_metrics(pred)
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # a resumed run starts from the best metric of the restored checkpoint, so an
+        # evaluation that does not beat an earlier attempt's best is not kept
+        self._best = state.best_metric
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        name = args.metric_for_best_model or "loss"
+        value = metrics.get(name if name.startswith("eval_") else f"eval_{name}")
+        if value is None:
+            return
+        better = (lambda a, b: a > b) if args.greater_is_better else (lambda a, b: a < b)
+        if self._best is None or better(value, self._best):
+            self._best = value
+            self.predictions = self._latest
+            self.metrics = dict(metrics)
+
+
+def save_predictions(output_dir, pred, label_dict, rows=None):
+    """
+    Write eval predictions computed with top_k_predictions to output_dir/predictions.arrow,
+    an Arrow IPC file with row, label, prediction, top_k_labels and top_k_probs columns, and
+    the full logits, if kept, to output_dir/logits.npy. rows is the eval dataset row of each
+    prediction, from CellClassificationTrainer.eval_rows, and defaults to dataset order.
+    """
+    import json
+    import numpy as np
+    import pyarrow as pa
+
+    probs, indices = pred.predictions[:2]
+    k = indices.shape[1]
+    if rows is None:
+        rows = np.arange(len(indices))
+    table = pa.table(
+        {
+            "row": pa.array(np.asarray(rows, dtype=np.int64)),
+            "label": pa.array(pred.label_ids.astype(np.int32)),
+            "prediction": pa.array(indices[:, 0].astype(np.int32)),
+            "top_k_labels": pa.FixedSizeListArray.from_arrays(
+                pa.array(indices.astype(np.int32).ravel()), k
+            ),
+            "top_k_probs": pa.FixedSizeListArray.from_arrays(
+                pa.array(probs.astype(np.float16).ravel()), k
+            ),
+        }
+    ).replace_schema_metadata({"label_dict": json.dumps(label_dict)})
+    with pa.OSFile(os.path.join(output_dir, "predictions.arrow"), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    if len(pred.predictions) > 2:
+        np.save(os.path.join(output_dir, "logits.npy"), pred.predictions[2].astype(np.float16))
+
+
+class CheckpointUploadCallback(TrainerCallback):
+    """
+    Upload every checkpoint the Trainer saves to store_key/checkpoint-<step> in the
+    background, overlapping with the next epoch. Uploads run one at a time in save order,
+    and training only waits for them at the end. Only the main process uploads.
+    The datastore is a DataStore or a ChunkStore.
+    """
+
+    def __init__(self, datastore, store_key):
+        self.datastore = datastore
+        self.store_key = store_key
+        self._pool = ThreadPoolExecutor(1)
+        self._uploads = []
+
+    def on_save(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        name = f"checkpoint-{state.global_step}"
+        self._uploads.append(
+            self._pool.submit(
+                self.datastore.upload,
+                local_path=os.path.join(args.output_dir, name),
+                store_key=os.path.join(self.store_key, name),
+            )
+        )
+
+    def on_train_end(self, args, state, control, **kwargs):
+        for upload in self._uploads:
+            upload.result()
+        self._pool.shutdown()
+
+
+def restore_checkpoints(datastore, store_key, output_dir):
+    """
+    Download the complete checkpoints stored under store_key by CheckpointUploadCallback
+    into output_dir, where the Trainer saved them, so the best checkpoint can still be
+    loaded at the end of a resumed run. Checkpoints without an upload manifest were cut off
+    mid-upload and are skipped.
+
+    Returns the local path of the latest checkpoint, or None if there is none.
+    """
+    from datastore import MANIFEST_NAME
+
+    manifest_name = getattr(datastore, "manifest_name", MANIFEST_NAME)
+    steps = []
+    for key, _ in datastore._iter_objects(store_key):
+        match = re.fullmatch(rf"checkpoint-(\d+)/{re.escape(manifest_name)}", key)
+        if match:
+            steps.append(int(match.group(1)))
+    for step in sorted(steps):
+        name = f"checkpoint-{step}"
+        datastore.download(
+            download_path=os.path.join(output_dir, name),
+            store_key=os.path.join(store_key, name),
+        )
+    if not steps:
+        return None
+    return os.path.join(output_dir, f"checkpoint-{max(steps)}")
+
+
+class CellClassificationTrainer(Trainer):
+    """
+    Trainer used by ModelOps._finetune. Streaming datasets are read shard by shard
+    instead of through the length-grouped sampler, which would read every row up front.
+    With max_tokens_per_batch, datasets are batched by TokenBudgetBatchSampler and training
+    logs report the padding ratio and tokens/sec. Distributed evaluation keeps fixed-size
+    batches.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self._padding_stats = None
+        self._last_log_time = time.time()
+        self._token_budget_eval = False
+
+    def _uses_token_budget(self, dataset):
+        return self.max_tokens_per_batch and not isinstance(dataset, StreamingArrowDataset)
+
+    def _uses_token_budget_eval(self, dataset):
+        # predictions are gathered across workers only along the batch dimension, so
+        # distributed evaluation needs batches of the same number of cells on every worker
+        return self._uses_token_budget(dataset) and self.args.world_size == 1
+
+    def _token_budget_dataloader(self, dataset, description, shuffle, collator):
+        lengths = dataset[self.args.length_column_name]
+        dataset = self._remove_unused_columns(dataset, description=description)
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=TokenBudgetBatchSampler(
+                lengths, self.max_tokens_per_batch, shuffle=shuffle, seed=self.args.seed
+            ),
+            collate_fn=collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        if hasattr(self, "accelerator"):
+            return self.accelerator.prepare(dataloader)
+        return dataloader
+
+    def get_train_dataloader(self):
+        if not self._uses_token_budget(self.train_dataset):
+            return super().get_train_dataloader()
+        self._padding_stats = PaddingStatsCollator(self.data_collator)
+        self._last_log_time = time.time()
+        return self._token_budget_dataloader(
+            self.train_dataset, "training", shuffle=True, collator=self._padding_stats
+        )
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        if eval_dataset is None:
+            eval_dataset = self.eval_dataset
+        elif isinstance(eval_dataset, str):
+            eval_dataset = self.eval_dataset[eval_dataset]
+        self._token_budget_eval = self._uses_token_budget_eval(eval_dataset)
+        if not self._token_budget_eval:
+            return super().get_eval_dataloader(eval_dataset)
+        return self._token_budget_dataloader(
+            eval_dataset, "evaluation", shuffle=False, collator=self.data_collator
+        )
+
+    def get_test_dataloader(self, test_dataset):
+        # predict batches like evaluate, so eval_rows holds for both
+        self._token_budget_eval = self._uses_token_budget_eval(test_dataset)
+        if not self._token_budget_eval:
+            return super().get_test_dataloader(test_dataset)
+        return self._token_budget_dataloader(
+            test_dataset, "test", shuffle=False, collator=self.data_collator
+        )
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None):
+        loss, logits, labels = super().prediction_step(
+            model, inputs, prediction_loss_only, ignore_keys=ignore_keys
+        )
+        if loss is not None and self._token_budget_eval:
+            # evaluation_loop repeats every batch's mean loss eval_batch_size times, which
+            # weighs token-budget batches of a few long cells like those of many short ones.
+            # Repeating it once per cell first makes eval_loss the mean over cells.
+            loss = loss.repeat(find_batch_size(inputs))
+        return loss, logits, labels
+
+    def eval_rows(self, eval_dataset=None):
+        """
+        Dataset row of each prediction evaluate and predict return for eval_dataset, in
+        their order. Token-budget batches are in length order, other datasets in row order.
+        """
+        import numpy as np
+
+        eval_dataset = self.eval_dataset if eval_dataset is None else eval_dataset
+        if not self._uses_token_budget_eval(eval_dataset):
+            return np.arange(len(eval_dataset))
+        sampler = TokenBudgetBatchSampler(
+            eval_dataset[self.args.length_column_name], self.max_tokens_per_batch, shuffle=False
+        )
+        return np.concatenate([np.asarray(batch) for batch in sampler])
+
+    def log(self, logs, *args, **kwargs):
+        stats = self._padding_stats
+        if stats is not None and "loss" in logs and stats.padded_tokens:
+            now = time.time()
+            logs["padding_ratio"] = 1 - stats.real_tokens / stats.padded_tokens
+            logs["tokens_per_second"] = stats.real_tokens / max(now - self._last_log_time, 1e-6)
+            stats.reset()
+            self._last_log_time = now
+        super().log(logs, *args, **kwargs)
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if isinstance(self.train_dataset, StreamingArrowDataset):
+            return ShardGroupedSampler(self.train_dataset, seed=self.args.seed)
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def _get_eval_sampler(self, eval_dataset, *args, **kwargs):
+        if isinstance(eval_dataset, StreamingArrowDataset):
+            return ShardGroupedSampler(eval_dataset, shuffle=False)
+        return super()._get_eval_sampler(eval_dataset, *args, **kwargs)
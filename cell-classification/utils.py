@@ -1,217 +1,441 @@
-from metaflow.metaflow_config import DATATOOLS_S3ROOT
-from metaflow import S3
 import os
-import shutil
-import subprocess
+import json
+import uuid
+import hashlib
 from config import *
-from tempfile import TemporaryDirectory
-
-
-class DataStore:
-
-    _store_root = DATATOOLS_S3ROOT
-
-    @property
-    def root(self):
-        return self._store_root
-
-    @staticmethod
-    def _walk_directory(root):
-        path_keys = []
-        for path, subdirs, files in os.walk(root):
-            for name in files:
-                # create a tuple of (key, path)
-                path_keys.append(
-                    (
-                        os.path.relpath(os.path.join(path, name), root),
-                        os.path.join(path, name),
-                    )
-                )
-        return path_keys
+from datastore import DataStore
+import modelstore
+
+# bump when partition_organs changes which rows end up in a split
+PREPROCESS_VERSION = 2
+
+
+def _column_codes(dataset, column):
+    """
+    Dictionary-encode a column on its Arrow buffers.
+    Returns the code of every row (-1 for nulls) and the values in order of first appearance.
+    """
+    import numpy as np
+    import pyarrow.compute as pc
+
+    values = dataset.with_format("arrow")[column].combine_chunks()
+    encoded = pc.dictionary_encode(values)
+    codes = pc.fill_null(encoded.indices, -1).to_numpy(zero_copy_only=False)
+    return codes.astype(np.int64), encoded.dictionary.to_pylist()
+
+
+def partition_organs(
+    dataset,
+    organ_merge=ORGAN_MERGE,
+    rare_fraction=RARE_CELL_TYPE_FRACTION,
+    seed=SHUFFLE_SEED,
+    train_fraction=TRAIN_FRACTION,
+    stratified=STRATIFIED_SPLIT,
+):
+    """
+    Compute the train/eval rows and label ids of every organ in one pass over the
+    organ_major and cell_type columns.
+
+    Returns a list of dicts, one per organ in order of first appearance, with the organ name,
+    its label dict (cell type : label id) and the row indices and label ids of both splits.
+    Rows are those the per-organ filter, rare cell type pruning, shuffle and split would select.
+    A stratified split takes the first train_fraction of every cell type's shuffled rows
+    (at least one) for training, otherwise the first train_fraction of the organ's rows,
+    with cell types missing from training dropped from eval.
+    """
+    import numpy as np
+
+    organ_codes, organs = _column_codes(dataset, "organ_major")
+    cell_codes, cell_types = _column_codes(dataset, "cell_type")
+    num_organs, num_cell_types = len(organs), len(cell_types)
+
+    # code of the organ split each organ is trained in, -1 when it is dropped
+    split_of_organ = np.arange(num_organs)
+    for i, organ in enumerate(organs):
+        if organ in organ_merge:
+            merged = organ_merge[organ]
+            split_of_organ[i] = organs.index(merged) if merged in organs else -1
+    split_codes = np.where(organ_codes >= 0, split_of_organ[organ_codes], -1)
+    valid = (split_codes >= 0) & (cell_codes >= 0)
+
+    # cell type counts of every organ split at once
+    counts = np.bincount(
+        split_codes[valid] * num_cell_types + cell_codes[valid],
+        minlength=num_organs * num_cell_types,
+    ).reshape(num_organs, num_cell_types)
+    keep_cell_type = counts > rare_fraction * counts.sum(axis=1, keepdims=True)
+    keep = valid & keep_cell_type[split_codes.clip(0), cell_codes.clip(0)]
+
+    # group the kept rows by organ split, a stable sort keeps dataset order within a split
+    rows = np.flatnonzero(keep)
+    rows = rows[np.argsort(split_codes[rows], kind="stable")]
+    boundaries = np.concatenate(
+        [[0], np.cumsum(np.bincount(split_codes[rows], minlength=num_organs))]
+    )
+
+    partitions = []
+    for split_code, organ in enumerate(organs):
+        if split_of_organ[split_code] != split_code:
+            continue
+        organ_rows = rows[boundaries[split_code] : boundaries[split_code + 1]]
+        # the same permutation Dataset.shuffle(seed=seed) draws
+        organ_rows = organ_rows[np.random.default_rng(seed).permutation(len(organ_rows))]
+
+        # label ids in order of first appearance in the shuffled rows
+        organ_cell_codes = cell_codes[organ_rows]
+        present, first_seen = np.unique(organ_cell_codes, return_index=True)
+        present = present[np.argsort(first_seen)]
+        label_ids = np.full(num_cell_types, -1)
+        label_ids[present] = np.arange(len(present))
+        labels = label_ids[organ_cell_codes]
+
+        if stratified:
+            # rank of every row among the rows of its label, in shuffled order
+            by_label = np.argsort(labels, kind="stable")
+            label_counts = np.bincount(labels, minlength=len(present))
+            label_starts = np.concatenate([[0], np.cumsum(label_counts)[:-1]])
+            ranks = np.empty(len(labels), dtype=np.int64)
+            ranks[by_label] = np.arange(len(labels)) - np.repeat(label_starts, label_counts)
+            label_num_train = np.clip(
+                np.floor(label_counts * train_fraction + 0.5), 1, label_counts
+            )
+            train_mask = ranks < label_num_train[labels]
+            eval_mask = ~train_mask
+        else:
+            num_train = round(len(organ_rows) * train_fraction)
+            train_mask = np.arange(len(organ_rows)) < num_train
+            # evaluate only on cell types seen in training
+            eval_mask = ~train_mask & np.isin(labels, labels[train_mask])
+        partitions.append(
+            {
+                "organ": organ,
+                "label_dict": {cell_types[code]: i for i, code in enumerate(present)},
+                "train_indices": organ_rows[train_mask],
+                "train_labels": labels[train_mask],
+                "eval_indices": organ_rows[eval_mask],
+                "eval_labels": labels[eval_mask],
+            }
+        )
+    return partitions
+
+
+def preprocess_cache_key(input_fingerprint):
+    "Key of the organ splits computed from an input dataset with the current preprocessing rules."
+    inputs = {
+        "input_fingerprint": input_fingerprint,
+        "organ_merge": ORGAN_MERGE,
+        "rare_cell_type_fraction": RARE_CELL_TYPE_FRACTION,
+        "shuffle_seed": SHUFFLE_SEED,
+        "train_fraction": TRAIN_FRACTION,
+        "stratified": STRATIFIED_SPLIT,
+        "version": PREPROCESS_VERSION,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def pack_organs(sizes, num_bins):
+    """
+    Group organs into at most num_bins bins of similar total size, largest organ first
+    into the currently smallest bin (longest processing time first).
+
+    Parameters
+    ----------
+    sizes : dict
+        Organ : size, e.g. bytes of its train and eval splits.
+    num_bins : int
+        Maximum number of bins.
+
+    Returns a list of non-empty bins, each a list of organs ordered largest first.
+    """
+    import heapq
+
+    heap = [(0, i) for i in range(min(num_bins, len(sizes)))]
+    bins = [[] for _ in heap]
+    for organ in sorted(sizes, key=sizes.get, reverse=True):
+        load, i = heapq.heappop(heap)
+        bins[i].append(organ)
+        heapq.heappush(heap, (load + sizes[organ], i))
+    return bins
+
+
+def distributed_backend():
+    "Process group backend for the node's hardware."
+    import torch
+
+    return "nccl" if torch.cuda.is_available() else "gloo"
+
+
+def _distributed_worker(rank, world_size, port, output_queue, args, kwargs):
+    "Entry point of a worker process spawned by ModelOps._finetune_distributed."
+    import torch
+    import torch.distributed as dist
+
+    os.environ.update(
+        {
+            "MASTER_ADDR": "127.0.0.1",
+            "MASTER_PORT": str(port),
+            "RANK": str(rank),
+            "LOCAL_RANK": str(rank),
+            "WORLD_SIZE": str(world_size),
+        }
+    )
+    if torch.cuda.is_available():
+        torch.cuda.set_device(rank)
+    else:
+        # split the node's cores between the workers
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group(distributed_backend(), rank=rank, world_size=world_size)
+    try:
+        output_dir = ModelOps()._finetune(*args, **kwargs)
+        if rank == 0:
+            output_queue.put(output_dir)
+    finally:
+        dist.destroy_process_group()
+
+
+def sample_trials(space=SWEEP_SPACE, num_trials=SWEEP_NUM_TRIALS, seed=SWEEP_SEED):
+    """
+    Draw hyperparameter sets from a search space with hyperopt.
+
+    Parameters
+    ----------
+    space : dict
+        Hyperparameter name : ("loguniform", low, high), ("uniform", low, high) or
+        ("choice", options).
+    num_trials : int
+        Number of sets drawn.
+    seed : int
+        Seed of the draw.
+
+    Returns a list of dicts of hyperparameter name : value.
+    """
+    import math
+    import numpy as np
+    from hyperopt import hp
+    from hyperopt.pyll.stochastic import sample
+
+    def dimension(name, kind, *args):
+        if kind == "loguniform":
+            low, high = args
+            return hp.loguniform(name, math.log(low), math.log(high))
+        if kind == "uniform":
+            return hp.uniform(name, *args)
+        if kind == "choice":
+            return hp.choice(name, *args)
+        raise ValueError(f"Unknown search space dimension {kind} for {name}")
+
+    hyperopt_space = {name: dimension(name, *spec) for name, spec in space.items()}
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(num_trials):
+        trial = sample(hyperopt_space, rng=rng)
+        # plain Python values, so trials serialize to JSON and artifact names
+        trials.append(
+            {
+                name: value.item() if hasattr(value, "item") else value
+                for name, value in trial.items()
+            }
+        )
+    return trials
 
-    def _upload_directory(self, local_path, store_key=""):
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            s3.put_files(self._walk_directory(local_path))
 
-    def already_exists(self, store_key=""):
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            if len(s3.list_paths()) == 0:
-                return False
-        return True
+def _organ_splits(dataset, partition):
+    """
+    Build the train and eval datasets of an organ partition, with cell type names replaced
+    by label ids. The organ's rows are gathered once into a contiguous table (train rows
+    first), and both splits are slices of it, so reading them needs no indices mapping.
+    """
+    import numpy as np
 
-    def _download_directory(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        download_path : str
-            Path to the folder where the store contents will be downloaded
-        store_key : str
-            Key suffixed to the store_root to save the store contents to
-        """
-        final_path = os.path.join(self._store_root, store_key)
-        os.makedirs(download_path, exist_ok=True)
-        with S3(s3root=final_path) as s3:
-            for s3obj in s3.get_all():
-                move_path = os.path.join(download_path, s3obj.key)
-                if not os.path.exists(os.path.dirname(move_path)):
-                    os.makedirs(os.path.dirname(move_path), exist_ok=True)
-                shutil.move(s3obj.path, os.path.join(download_path, s3obj.key))
-
-    def upload(self, local_path, store_key=""):
-        """
-        Parameters
-        ----------
-        local_path : str
-            Path to the store contents to be saved in cloud object storage.
-        store_key : str
-            Key suffixed to the store_root to save the store contents to.
-        """
-        if os.path.isdir(local_path):
-            self._upload_directory(local_path, store_key)
-        else:
-            final_path = os.path.join(self._store_root, store_key)
-            with S3(s3root=final_path) as s3:
-                s3.put_files([(local_path, local_path)])
+    num_train = len(partition["train_indices"])
+    organ_dataset = (
+        dataset.select(
+            np.concatenate([partition["train_indices"], partition["eval_indices"]])
+        )
+        .remove_columns(["cell_type", "organ_major"])
+        # adding a column flattens the indices mapping into a new table
+        .add_column(
+            "label", np.concatenate([partition["train_labels"], partition["eval_labels"]])
+        )
+    )
+    return (
+        organ_dataset.select(range(0, num_train)),
+        organ_dataset.select(range(num_train, len(organ_dataset))),
+    )
 
-    def download(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        store_key : str
-            Key suffixed to the store_root to download the store contents from
-        download_path : str
-            Path to the folder where the store contents will be downloaded
-        """
-        if not self.already_exists(store_key):
-            raise ValueError(
-                f"Model with key {store_key} does not exist in {self._store_root}"
-            )
-        self._download_directory(download_path, store_key)
 
-    def upload_hf_dataset(self, dataset, store_key=""):
+class ModelOps:
+    def _iter_organ_splits(self, train_dataset):
         """
-        Parameters
-        ----------
-        dataset : datasets.Dataset
-            Huggingface dataset to be saved in cloud object storage.
-        store_key : str
-            Key suffixed to the store_root to save the store contents to.
+        Yield (organ, trainset, evalset, label dict) for one organ at a time, so each organ's
+        splits are only built when the consumer is ready for them.
         """
-        with TemporaryDirectory() as temp_dir: 
-            # OK for small data. For big data, use a different method.
-            dataset.save_to_disk(temp_dir)
-            self.upload(temp_dir, store_key)
-
-
-class ModelOps:
-    def _preprocess(self, train_dataset):
         print(
             "\nPreprocessing data - each organ type represented will be printed sequentially...\n"
         )
-        from collections import Counter
-
-        dataset_list = []
-        evalset_list = []
-        organ_list = []
-        target_dict_list = []
-
-        for organ in Counter(train_dataset["organ_major"]).keys():
-            # collect list of tissues for fine-tuning (immune and bone marrow are included together)
-            if organ in ["bone_marrow"]:
-                continue
-            elif organ == "immune":
-                organ_ids = ["immune", "bone_marrow"]
-                organ_list += ["immune"]
-            else:
-                organ_ids = [organ]
-                organ_list += [organ]
-
-            print(organ)
-
-            # filter datasets for given organ
-            def if_organ(example):
-                return example["organ_major"] in organ_ids
-
-            trainset_organ = train_dataset.filter(if_organ, num_proc=NUM_CPUS)
-
-            # per scDeepsort published method, drop cell types representing <0.5% of cells
-            celltype_counter = Counter(trainset_organ["cell_type"])
-            total_cells = sum(celltype_counter.values())
-            cells_to_keep = [
-                k for k, v in celltype_counter.items() if v > (0.005 * total_cells)
-            ]
-
-            def if_not_rare_celltype(example):
-                return example["cell_type"] in cells_to_keep
-
-            trainset_organ_subset = trainset_organ.filter(
-                if_not_rare_celltype, num_proc=NUM_CPUS
-            )
-
-            # shuffle datasets and rename columns
-            trainset_organ_shuffled = trainset_organ_subset.shuffle(seed=42)
-            trainset_organ_shuffled = trainset_organ_shuffled.rename_column(
-                "cell_type", "label"
-            )
-            trainset_organ_shuffled = trainset_organ_shuffled.remove_columns(
-                "organ_major"
-            )
+        for partition in partition_organs(train_dataset):
+            print(partition["organ"])
+            organ_trainset, organ_evalset = _organ_splits(train_dataset, partition)
+            yield partition["organ"], organ_trainset, organ_evalset, partition["label_dict"]
 
-            # create dictionary of cell types : label ids
-            target_names = list(Counter(trainset_organ_shuffled["label"]).keys())
-            target_name_id_dict = dict(
-                zip(target_names, [i for i in range(len(target_names))])
-            )
-            target_dict_list += [target_name_id_dict]
+    def _load_model_splits(self, data_key):
+        """
+        Organ splits of the dataset stored at data_key, as dicts with the organ, the datastore
+        keys of its train and eval splits and its label dict. With PREPROCESS_CACHE, splits
+        are stored under a key derived from the input data and preprocessing rules, so later
+        runs with the same inputs reuse them. Otherwise they are stored under a key of their
+        own, leaving cached splits untouched. Returns the splits and whether they were reused.
+        """
+        if not PREPROCESS_CACHE:
+            splits_key = os.path.join(DATA_KEY, "preprocessed", f"uncached-{uuid.uuid4().hex}")
+            return self._preprocess_and_store(data_key, splits_key), False
 
-            # change labels to numerical ids
-            def classes_to_ids(example):
-                example["label"] = target_name_id_dict[example["label"]]
-                return example
+        splits_key = os.path.join(
+            DATA_KEY, "preprocessed", preprocess_cache_key(self.fingerprint(data_key))
+        )
+        index_key = os.path.join(splits_key, "model_splits.json")
+        model_splits = self.get_json(index_key)
+        if model_splits is not None:
+            print(f"Reusing organ splits stored under {splits_key}")
+            return model_splits, True
+        model_splits = self._preprocess_and_store(data_key, splits_key)
+        # written last, marks the splits as complete
+        self.put_json(index_key, model_splits)
+        return model_splits, False
+
+    def _split_size(self, split):
+        "Stored bytes of an organ's train and eval splits."
+        return sum(
+            info["size"]
+            for key in (split["organ_trainset_key"], split["organ_evalset_key"])
+            for info in self._read_manifest(key)["files"].values()
+        )
 
-            labeled_trainset = trainset_organ_shuffled.map(
-                classes_to_ids, num_proc=NUM_CPUS
-            )
+    def _preprocess_and_store(self, data_key, splits_key):
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import BoundedSemaphore
+        from datasets import load_from_disk
+
+        self.download(download_path=DATA_DIR, store_key=data_key)
+        train_dataset = load_from_disk(DATA_DIR)
+
+        # organs are uploaded in the background while the next one is built,
+        # with at most PREPROCESS_MAX_INFLIGHT_ORGANS organs held at a time
+        in_flight = BoundedSemaphore(PREPROCESS_MAX_INFLIGHT_ORGANS)
+
+        def store(organ, organ_trainset, organ_evalset, organ_label_dict):
+            try:
+                train_key = os.path.join(splits_key, f"{organ}_trainset")
+                self.upload_hf_dataset(organ_trainset, train_key)
+                eval_key = os.path.join(splits_key, f"{organ}_evalset")
+                self.upload_hf_dataset(organ_evalset, eval_key)
+            finally:
+                in_flight.release()
+            return {
+                "organ": organ,
+                "organ_trainset_key": train_key,
+                "organ_evalset_key": eval_key,
+                "organ_label_dict": organ_label_dict
+            }
+
+        organ_splits = self._iter_organ_splits(train_dataset)
+        futures = []
+        with ThreadPoolExecutor(PREPROCESS_MAX_INFLIGHT_ORGANS) as pool:
+            while True:
+                in_flight.acquire()
+                organ_split = next(organ_splits, None)
+                if organ_split is None:
+                    in_flight.release()
+                    break
+                futures.append(pool.submit(store, *organ_split))
+            return [future.result() for future in futures]
+
+    def _embeddings_key(self, split):
+        "Datastore key of the frozen-backbone embeddings of an organ split."
+        splits_key = os.path.dirname(split["organ_trainset_key"])
+        model_tag = f"{os.path.basename(os.path.normpath(PRETRAINED_MODEL_PATH))}_L{EMBEDDING_LAYER}"
+        return os.path.join(splits_key, "embeddings", model_tag, split["organ"])
+
+    def _load_split(self, split, stream=STREAM_TRAINING_DATA):
+        "Train and eval datasets of a stored organ split, streamed or downloaded."
+        from datasets import load_from_disk
+
+        if stream:
+            from streaming import StreamingArrowDataset
+            organ_trainset = StreamingArrowDataset(split["organ_trainset_key"], datastore=self)
+            organ_evalset = StreamingArrowDataset(split["organ_evalset_key"], datastore=self)
+        else:
+            self.download(download_path=split["organ"] + "_trainset", store_key=split["organ_trainset_key"])
+            self.download(download_path=split["organ"] + "_evalset", store_key=split["organ_evalset_key"])
+            organ_trainset = load_from_disk(split["organ"] + "_trainset")
+            organ_evalset = load_from_disk(split["organ"] + "_evalset")
+        return organ_trainset, organ_evalset
 
-            # create 80/20 train/eval splits
-            labeled_train_split = labeled_trainset.select(
-                [i for i in range(0, round(len(labeled_trainset) * 0.8))]
-            )
-            labeled_eval_split = labeled_trainset.select(
-                [
-                    i
-                    for i in range(
-                        round(len(labeled_trainset) * 0.8), len(labeled_trainset)
-                    )
-                ]
-            )
+    def _load_backbone(self, pretrained_path=PRETRAINED_MODEL_PATH):
+        """
+        Load the pretrained weights once, for training several organs in a task.
+        Returns the model config and the BERT encoder weights on CPU.
+        """
+        from transformers import BertForSequenceClassification
 
-            # filter dataset for cell types in corresponding training set
-            trained_labels = list(Counter(labeled_train_split["label"]).keys())
+        model = modelstore.load_model(
+            BertForSequenceClassification,
+            pretrained_path,
+            output_attentions=False,
+            output_hidden_states=False,
+        )
+        return model.config, model.bert.state_dict()
 
-            def if_trained_label(example):
-                return example["label"] in trained_labels
+    def _load_classifier(self, num_labels, pretrained_path=PRETRAINED_MODEL_PATH, backbone=None):
+        "Pretrained classifier with a freshly initialized head of num_labels outputs."
+        import copy
+        from transformers import BertForSequenceClassification
 
-            labeled_eval_split_subset = labeled_eval_split.filter(
-                if_trained_label, num_proc=NUM_CPUS
+        if backbone is None:
+            return modelstore.load_model(
+                BertForSequenceClassification,
+                pretrained_path,
+                num_labels=num_labels,
+                output_attentions=False,
+                output_hidden_states=False,
             )
-
-            dataset_list += [labeled_train_split]
-            evalset_list += [labeled_eval_split_subset]
-
-        trainset_dict = dict(zip(organ_list, dataset_list))
-        traintargetdict_dict = dict(zip(organ_list, target_dict_list))
-        evalset_dict = dict(zip(organ_list, evalset_list))
-
-        return trainset_dict, traintargetdict_dict, evalset_dict, organ_list
+        config, state_dict = backbone
+        config = copy.deepcopy(config)
+        config.num_labels = num_labels
+        config.id2label = {i: f"LABEL_{i}" for i in range(num_labels)}
+        config.label2id = {label: i for i, label in config.id2label.items()}
+        model = BertForSequenceClassification(config)
+        model.bert.load_state_dict(state_dict)
+        return model
+
+    def _add_lora_adapters(self, model):
+        "Wrap a classifier for LoRA finetuning, training only the adapters and the head."
+        try:
+            from peft import LoraConfig, TaskType, get_peft_model
+        except ImportError:
+            raise ImportError("FINETUNE_MODE = 'lora' requires peft, pip install peft")
+
+        lora_config = LoraConfig(
+            task_type=TaskType.SEQ_CLS,
+            r=LORA_R,
+            lora_alpha=LORA_ALPHA,
+            lora_dropout=LORA_DROPOUT,
+            target_modules=LORA_TARGET_MODULES,
+            modules_to_save=["classifier"],
+        )
+        model = get_peft_model(model, lora_config)
+        model.print_trainable_parameters()
+        return model
 
     def compute_metrics(self, pred):
         from sklearn.metrics import accuracy_score, f1_score
 
         labels = pred.label_ids
-        preds = pred.predictions.argmax(-1)
+        if isinstance(pred.predictions, tuple):
+            # top k probabilities and labels from top_k_predictions, best label first
+            preds = pred.predictions[1][:, 0]
+        else:
+            preds = pred.predictions.argmax(-1)
         acc = accuracy_score(labels, preds)
         macro_f1 = f1_score(labels, preds, average="macro")
         return {"accuracy": acc, "macro_f1": macro_f1}
@@ -223,42 +447,100 @@ class ModelOps:
         organ_evalset,
         organ_label_dict,
         checkpoint_path,
-        pretrained_path="/Geneformer/geneformer-12L-30M",  # absolute path set in Dockerfile
+        pretrained_path=PRETRAINED_MODEL_PATH,
+        backbone=None,
+        checkpoint_store_key=None,
+        hyperparameters=None,
     ):
 
         print("Finetuning model for organ: ", organ)
 
-        from transformers import BertForSequenceClassification
-        from transformers import Trainer
         from transformers.training_args import TrainingArguments
+        from training import (
+            CellClassificationTrainer,
+            TokenBudgetBatchSampler,
+            ProfileCallback,
+            CheckpointUploadCallback,
+            BestEvalOutputs,
+            restore_checkpoints,
+            save_predictions,
+            top_k_predictions,
+            freeze_backbone,
+            mixed_precision_args,
+        )
+        from streaming import StreamingArrowDataset
         from geneformer import DataCollatorForCellClassification
         import datetime
-        import pickle
         import subprocess
         import seaborn as sns
 
         sns.set()
+        profile = dict(TRAINING_PROFILES[TRAINING_PROFILE])
 
-        # set logging steps
-        logging_steps = round(len(organ_trainset) / GENEFORMER_BATCH_SIZE / 10)
+        # config hyperparameters, with the overrides of e.g. a sweep trial
+        hyperparameters = {
+            "max_lr": MAX_LR,
+            "lr_schedule_fn": LR_SCHEDULE_FN,
+            "warmup_steps": WARMUP_STEPS,
+            "epochs": EPOCHS,
+            "freeze_layers": profile["freeze_layers"],
+            **(hyperparameters or {}),
+        }
+        max_lr, lr_schedule_fn = hyperparameters["max_lr"], hyperparameters["lr_schedule_fn"]
+        warmup_steps, epochs = hyperparameters["warmup_steps"], hyperparameters["epochs"]
+        profile["freeze_layers"] = hyperparameters["freeze_layers"]
+        # as in the default profile, freezing any encoder layer also freezes the embeddings
+        profile["freeze_embeddings"] = (
+            profile["freeze_embeddings"] or hyperparameters["freeze_layers"] > 0
+        )
 
-        # reload pretrained model
-        model = BertForSequenceClassification.from_pretrained(
-            pretrained_path,
-            num_labels=len(organ_label_dict.keys()),
-            output_attentions=False,
-            output_hidden_states=False,
-        ).to("cuda")
+        # set logging steps, each distributed worker trains on its share of the batches
+        world_size = int(os.environ.get("WORLD_SIZE", 1))
+        use_token_budget = MAX_TOKENS_PER_BATCH and not isinstance(
+            organ_trainset, StreamingArrowDataset
+        )
+        if use_token_budget:
+            num_batches = len(
+                TokenBudgetBatchSampler(organ_trainset["length"], MAX_TOKENS_PER_BATCH)
+            )
+        else:
+            num_batches = len(organ_trainset) / GENEFORMER_BATCH_SIZE
+        logging_steps = max(1, round(num_batches / world_size / 10))
+        batch_tag = f"T{MAX_TOKENS_PER_BATCH}" if use_token_budget else f"B{GENEFORMER_BATCH_SIZE}"
+
+        # accumulate gradients until the profile's effective batch size, in cells
+        gradient_accumulation_steps = 1
+        if profile["effective_batch_size"]:
+            cells_per_batch = len(organ_trainset) / num_batches if num_batches else 1
+            gradient_accumulation_steps = max(
+                1, round(profile["effective_batch_size"] / cells_per_batch)
+            )
+            logging_steps = max(1, round(logging_steps / gradient_accumulation_steps))
+
+        # reload pretrained model, or reuse the backbone weights already in memory,
+        # the trainer moves it to the worker's device
+        model = self._load_classifier(len(organ_label_dict.keys()), pretrained_path, backbone)
+        use_lora = FINETUNE_MODE == "lora"
+        if use_lora:
+            model = self._add_lora_adapters(model)
+        else:
+            frozen = freeze_backbone(
+                model, profile["freeze_embeddings"], profile["freeze_layers"]
+            )
+            print(f"Training profile {TRAINING_PROFILE}: {frozen} parameters frozen")
+        if profile["gradient_checkpointing"] and (use_lora or profile["freeze_embeddings"]):
+            # checkpointed layers only backpropagate when their inputs require grad
+            model.enable_input_require_grads()
 
         # define output directory path
         current_date = datetime.datetime.now()
         datestamp = f"{str(current_date.year)[-2:]}{current_date.month:02d}{current_date.day:02d}"
-        output_dir = f"{checkpoint_path}/{datestamp}_geneformer_CellClassifier_{organ}_L{MAX_INPUT_SIZE}_B{GENEFORMER_BATCH_SIZE}_LR{MAX_LR}_LS{LR_SCHEDULE_FN}_WU{WARMUP_STEPS}_E{EPOCHS}_O{OPTIMIZER}_F{FREEZE_LAYERS}/"
+        output_dir = f"{checkpoint_path}/{datestamp}_geneformer_CellClassifier_{organ}_L{MAX_INPUT_SIZE}_{batch_tag}_LR{max_lr}_LS{lr_schedule_fn}_WU{warmup_steps}_E{epochs}_O{OPTIMIZER}_F{profile['freeze_layers']}_P{TRAINING_PROFILE}{f'_LORA{LORA_R}' if use_lora else ''}/"
 
         # ensure not overwriting previously saved model
-        saved_model_test = os.path.join(output_dir, f"pytorch_model.bin")
-        if os.path.isfile(saved_model_test) == True:
-            raise Exception("Model already saved to this directory.")
+        for saved_model_name in (modelstore.PYTORCH_NAME, modelstore.SAFETENSORS_NAME):
+            if os.path.isfile(os.path.join(output_dir, saved_model_name)):
+                raise Exception("Model already saved to this directory.")
 
         # make output directory
         if not os.path.exists(output_dir):
@@ -266,7 +548,7 @@ class ModelOps:
 
         # set training arguments
         training_args = {
-            "learning_rate": MAX_LR,
+            "learning_rate": max_lr,
             "do_train": True,
             "do_eval": True,
             "evaluation_strategy": "epoch",
@@ -275,32 +557,128 @@ class ModelOps:
             "group_by_length": True,
             "length_column_name": "length",
             "disable_tqdm": False,
-            "lr_scheduler_type": LR_SCHEDULE_FN,
-            "warmup_steps": WARMUP_STEPS,
+            "lr_scheduler_type": lr_schedule_fn,
+            "warmup_steps": warmup_steps,
             "weight_decay": 0.001,
             "per_device_train_batch_size": GENEFORMER_BATCH_SIZE,
             "per_device_eval_batch_size": GENEFORMER_BATCH_SIZE,
-            "num_train_epochs": EPOCHS,
+            "num_train_epochs": epochs,
             "load_best_model_at_end": True,
             "output_dir": output_dir,
+            "gradient_accumulation_steps": gradient_accumulation_steps,
+            "gradient_checkpointing": profile["gradient_checkpointing"],
+            "save_safetensors": True,
+            **mixed_precision_args(profile["mixed_precision"]),
         }
+        if world_size > 1:
+            training_args["ddp_backend"] = distributed_backend()
 
         training_args_init = TrainingArguments(**training_args)
 
+        profile_callback = ProfileCallback()
+        best_eval = BestEvalOutputs(self.compute_metrics)
+        callbacks = [profile_callback, best_eval]
+
+        # stream checkpoints to the datastore as they are saved, and pick up from the
+        # latest complete one when this task is a retry
+        resume_from_checkpoint = None
+        if checkpoint_store_key is not None:
+            import torch.distributed as dist
+
+            datastore = DataStore()
+            if CHUNKED_CHECKPOINTS:
+                from chunkstore import ChunkStore
+
+                datastore = ChunkStore(datastore, chunks_key=os.path.join(DATA_KEY, "chunks"))
+            if int(os.environ.get("RANK", 0)) == 0:
+                resume_from_checkpoint = restore_checkpoints(
+                    datastore, checkpoint_store_key, output_dir
+                )
+            if dist.is_available() and dist.is_initialized():
+                # the other workers read the checkpoints worker 0 restored
+                resumed = [resume_from_checkpoint]
+                dist.broadcast_object_list(resumed, src=0)
+                resume_from_checkpoint = resumed[0]
+            if resume_from_checkpoint is not None:
+                print(f"Resuming {organ} from {resume_from_checkpoint}")
+            callbacks.append(CheckpointUploadCallback(datastore, checkpoint_store_key))
+
         # create the trainer
-        trainer = Trainer(
+        trainer = CellClassificationTrainer(
             model=model,
             args=training_args_init,
             data_collator=DataCollatorForCellClassification(),
             train_dataset=organ_trainset,
             eval_dataset=organ_evalset,
-            compute_metrics=self.compute_metrics,
+            compute_metrics=best_eval.compute_metrics,
+            preprocess_logits_for_metrics=top_k_predictions(
+                PREDICTIONS_TOP_K, PREDICTIONS_SAVE_LOGITS
+            ),
+            max_tokens_per_batch=MAX_TOKENS_PER_BATCH,
+            callbacks=callbacks,
         )
         # train the cell type classifier
-        trainer.train()
-        predictions = trainer.predict(organ_evalset)
-        with open(f"{output_dir}predictions.pickle", "wb") as fp:
-            pickle.dump(predictions, fp)
-        trainer.save_metrics("eval", predictions.metrics)
+        trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+        profile_results = {"profile": TRAINING_PROFILE, **profile, **profile_callback.results()}
+        print(f"Training profile results for {organ}: {profile_results}")
+        # the best model was loaded at the end of training and already evaluated
+        # on organ_evalset, only predict again if that evaluation ran in an earlier attempt
+        predictions, metrics = best_eval.predictions, best_eval.metrics
+        if predictions is None:
+            output = trainer.predict(organ_evalset, metric_key_prefix="eval")
+            predictions, metrics = output, output.metrics
+        # only the first worker writes files
+        if trainer.is_world_process_zero():
+            with open(os.path.join(output_dir, "profile_results.json"), "w") as f:
+                json.dump(profile_results, f, indent=2)
+            save_predictions(
+                output_dir, predictions, organ_label_dict, rows=trainer.eval_rows(organ_evalset)
+            )
+            with open(os.path.join(output_dir, "label_dict.json"), "w") as f:
+                json.dump(organ_label_dict, f)
+        trainer.save_metrics("eval", metrics)
         trainer.save_model(output_dir)
+        if checkpoint_store_key is not None and CHUNKED_CHECKPOINTS:
+            stats = dict(datastore.stats, dedup_ratio=datastore.dedup_ratio())
+            print(f"Checkpoint chunk store for {organ}: {stats}")
+            if trainer.is_world_process_zero():
+                with open(os.path.join(output_dir, "chunk_stats.json"), "w") as f:
+                    json.dump(stats, f, indent=2)
+        # adapters are saved on their own, the pretrained weights are already in the store
+        if trainer.is_world_process_zero() and not use_lora:
+            # safetensors in the output directory and the node-local cache, for fast loading
+            modelstore.store_model(output_dir)
         return output_dir
+
+    def _finetune_distributed(self, *args, num_workers=DISTRIBUTED_WORKERS, **kwargs):
+        """
+        Run _finetune in num_workers processes under torch.distributed, one per GPU on GPU
+        nodes and splitting the cores on CPU-only nodes. Each worker trains on its shard of
+        every batch and gradients are averaged across workers. Evaluation predictions are
+        gathered from all workers before compute_metrics, so metrics cover the whole eval set.
+        Takes the arguments of _finetune and returns its output directory, written by worker 0.
+        """
+        import socket
+        import torch
+        import torch.multiprocessing as mp
+
+        if num_workers is None:
+            num_workers = torch.cuda.device_count() if torch.cuda.is_available() else NUM_CPUS
+        if num_workers <= 1:
+            return self._finetune(*args, **kwargs)
+
+        # a free port for the workers' rendezvous
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        context = mp.get_context("spawn")
+        output_queue = context.SimpleQueue()
+        print(f"Finetuning with {num_workers} {distributed_backend()} workers")
+        mp.spawn(
+            _distributed_worker,
+            args=(num_workers, port, output_queue, args, kwargs),
+            nprocs=num_workers,
+            join=True,
+        )
+        return output_queue.get()
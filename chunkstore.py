@@ -0,0 +1,234 @@
+"""
+Deduplicating checkpoint store on top of DataStore.
+
+Files are split into chunks named by their sha256, every chunk is stored once under a
+shared chunk key, and each uploaded directory gets a manifest listing the chunks of its
+files. safetensors files are split at tensor boundaries, so a tensor that is unchanged
+across epochs (e.g. frozen layers) or identical across organs is stored once. Other files,
+such as optimizer states, are split with content-defined chunking, so an edit only changes
+the chunks around it.
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datastore import DataStore, DATASTORE_WORKERS
+
+# manifest written under every uploaded store key, after all of its chunks
+CHUNK_MANIFEST_NAME = ".chunk_manifest.json"
+# content-defined chunking: boundaries where the rolling sum of the last CDC_WINDOW byte
+# hashes has its low bits zero, giving chunks of about CDC_AVG_BYTES within the bounds
+CDC_WINDOW = 64
+CDC_AVG_BYTES = 2**20
+CDC_MIN_BYTES = 256 * 2**10
+CDC_MAX_BYTES = 8 * 2**20
+# chunks held in memory while they upload, reading waits for uploads beyond this
+CHUNK_UPLOAD_MAX_IN_FLIGHT = 4 * DATASTORE_WORKERS
+
+
+def _safetensors_boundaries(path):
+    """
+    Chunk boundaries of a safetensors file: the header, then every tensor's byte range.
+    Returns None if the file is not valid safetensors.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            return None
+        (header_size,) = struct.unpack("<Q", prefix)
+        if 8 + header_size > size:
+            return None
+        try:
+            header = json.loads(f.read(header_size))
+        except ValueError:
+            return None
+    data_start = 8 + header_size
+    boundaries = {data_start, size}
+    for name, entry in header.items():
+        if name != "__metadata__":
+            start, end = entry["data_offsets"]
+            boundaries.update((data_start + start, data_start + end))
+    return sorted(b for b in boundaries if 0 < b <= size)
+
+
+def _cdc_candidates(data, block_bytes=32 * 2**20):
+    """
+    Positions after which the rolling sum of the last CDC_WINDOW byte hashes has its low
+    bits zero, computed a block at a time to bound memory.
+    """
+    import numpy as np
+
+    # fixed pseudo-random hash of every byte value, the same on every node
+    byte_hashes = np.random.default_rng(0).integers(0, 2**32, 256, dtype=np.uint32)
+    mask = np.uint32(CDC_AVG_BYTES - 1)
+    view = np.frombuffer(data, dtype=np.uint8)
+    for block_start in range(0, len(view), block_bytes):
+        # the window reaches back into the previous block
+        offset = max(block_start - CDC_WINDOW, 0)
+        sums = np.cumsum(byte_hashes[view[offset : block_start + block_bytes]], dtype=np.uint32)
+        sums[CDC_WINDOW:] -= sums[:-CDC_WINDOW].copy()
+        positions = np.flatnonzero((sums & mask) == 0) + offset + 1
+        yield from positions[positions > block_start].tolist()
+
+
+def _cdc_boundaries(data):
+    "Content-defined chunk boundaries of a bytes-like object, ending with len(data)."
+    size = len(data)
+    boundaries = []
+    last = 0
+    for candidate in _cdc_candidates(data):
+        while candidate - last > CDC_MAX_BYTES:
+            last += CDC_MAX_BYTES
+            boundaries.append(last)
+        if candidate - last >= CDC_MIN_BYTES:
+            boundaries.append(candidate)
+            last = candidate
+    while size - last > CDC_MAX_BYTES:
+        last += CDC_MAX_BYTES
+        boundaries.append(last)
+    if last < size:
+        boundaries.append(size)
+    return boundaries
+
+
+def iter_chunks(path):
+    """
+    Yield the chunks of a file as bytes, at tensor boundaries for safetensors files.
+    The file is memory-mapped, so only the chunks being hashed or uploaded are in memory.
+    """
+    boundaries = None
+    if path.endswith(".safetensors"):
+        boundaries = _safetensors_boundaries(path)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if boundaries is None:
+                boundaries = _cdc_boundaries(data)
+            start = 0
+            for end in boundaries:
+                if end > start:
+                    yield data[start:end]
+                    start = end
+
+
+class ChunkStore:
+    """
+    Parameters
+    ----------
+    datastore : DataStore
+        Store the chunks and manifests are written to.
+    chunks_key : str
+        Key the chunks shared by every upload are stored under.
+    """
+
+    def __init__(self, datastore=None, chunks_key="chunks"):
+        self.datastore = datastore if datastore is not None else DataStore()
+        self.chunks_key = chunks_key
+        self.manifest_name = CHUNK_MANIFEST_NAME
+        self._known_chunks = set()
+        self._lock = threading.Lock()
+        self.stats = {"logical_bytes": 0, "unique_bytes": 0, "uploaded_bytes": 0}
+
+    def _chunk_key(self, digest):
+        return os.path.join(self.chunks_key, digest[:2], digest)
+
+    def _put_chunk(self, digest, data):
+        "Upload a chunk unless the store has it already. Returns the bytes uploaded."
+        with self._lock:
+            if digest in self._known_chunks:
+                return 0
+        key = self._chunk_key(digest)
+        uploaded = 0
+        if not self.datastore.backend.exists(key):
+            self.datastore.backend.put_bytes(key, data)
+            uploaded = len(data)
+        with self._lock:
+            self._known_chunks.add(digest)
+        return uploaded
+
+    def _iter_objects(self, store_key=""):
+        return self.datastore._iter_objects(store_key)
+
+    def upload(self, local_path, store_key="", max_in_flight=CHUNK_UPLOAD_MAX_IN_FLIGHT):
+        """
+        Upload the files of a directory as deduplicated chunks and write its manifest.
+        At most max_in_flight chunks are uploading at a time.
+
+        Returns
+        -------
+        dict
+            logical_bytes of the files, unique_bytes of their distinct chunks and
+            uploaded_bytes of the chunks the store did not have yet.
+        """
+        files = {}
+        seen = set()
+        stats = {"logical_bytes": 0, "unique_bytes": 0, "uploaded_bytes": 0}
+        pending = set()
+
+        def collect(futures):
+            for future in futures:
+                stats["uploaded_bytes"] += future.result()
+
+        with ThreadPoolExecutor(DATASTORE_WORKERS) as pool:
+            for key, path in DataStore._walk_directory(local_path):
+                chunks = []
+                for data in iter_chunks(path):
+                    digest = hashlib.sha256(data).hexdigest()
+                    chunks.append([digest, len(data)])
+                    if digest not in seen:
+                        seen.add(digest)
+                        stats["unique_bytes"] += len(data)
+                        if len(pending) >= max_in_flight:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        pending.add(pool.submit(self._put_chunk, digest, data))
+                files[key] = {"size": os.path.getsize(path), "chunks": chunks}
+                stats["logical_bytes"] += files[key]["size"]
+            collect(pending)
+        # the manifest goes last, so its presence marks the upload as complete
+        self.datastore.put_json(
+            os.path.join(store_key, CHUNK_MANIFEST_NAME), {"files": files}
+        )
+        for name, value in stats.items():
+            self.stats[name] += value
+        print(
+            f"Chunked upload to {store_key}: {stats['logical_bytes'] / 2**20:.1f}MB in files, "
+            f"{stats['uploaded_bytes'] / 2**20:.1f}MB of new chunks sent"
+        )
+        return stats
+
+    def download(self, download_path, store_key=""):
+        "Restore a directory uploaded with upload from its manifest and chunks."
+        manifest = self.datastore.get_json(os.path.join(store_key, CHUNK_MANIFEST_NAME))
+        if manifest is None:
+            raise ValueError(
+                f"No chunk manifest under {store_key} in {self.datastore.root}"
+            )
+
+        def fetch(digest):
+            data = self.datastore.backend.get_bytes(self._chunk_key(digest))
+            if data is None or hashlib.sha256(data).hexdigest() != digest:
+                raise ValueError(f"Chunk {digest} of {store_key} is missing or corrupt")
+            return data
+
+        with ThreadPoolExecutor(DATASTORE_WORKERS) as pool:
+            for key, entry in manifest["files"].items():
+                path = os.path.join(download_path, key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as f:
+                    for data in pool.map(fetch, [digest for digest, _ in entry["chunks"]]):
+                        f.write(data)
+
+    def dedup_ratio(self):
+        """
+        Bytes in the uploaded files per byte sent, over every upload of this store.
+        inf if every chunk was already stored.
+        """
+        if not self.stats["uploaded_bytes"]:
+            return float("inf") if self.stats["logical_bytes"] else 1.0
+        return self.stats["logical_bytes"] / self.stats["uploaded_bytes"]
@@ -1,13 +1,22 @@
 import subprocess
-from metaflow import S3
 import os
-import shutil
-import boto3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tempfile import TemporaryDirectory
+from datastore import get_backend
 try:
     import typer
     from rich.prompt import Prompt
-    from rich.progress import Progress, SpinnerColumn, TextColumn
+    from rich.progress import (
+        Progress,
+        SpinnerColumn,
+        TextColumn,
+        BarColumn,
+        DownloadColumn,
+        TransferSpeedColumn,
+        TimeRemainingColumn,
+    )
     from rich.text import Text
     from rich.console import Console
     from rich import print
@@ -42,28 +51,148 @@ DATASET_SAMPLES = [
     "genecorpus_30M_2048_lengths.pkl",
     "genecorpus_30M_2048_sorted_lengths.pkl",
     "token_dictionary.pkl",
-    # big files
+]
+# big files, only downloaded when asked for
+BIG_DATASET_SAMPLES = [
     "genecorpus_30M_2048.dataset"
 ]
+# objects downloaded concurrently
+DOWNLOAD_WORKERS = 8
+# size of the ranged reads streamed to disk
+DOWNLOAD_CHUNK_SIZE = 8 * 2**20
+
 
-def _download_directory(download_path, store_key=""):
-    final_path = os.path.join(S3_ROOT, store_key)
-    os.makedirs(download_path, exist_ok=True)
-    with S3(s3root=final_path, role=S3_ROLE) as s3:
-        for s3obj in s3.get_all():
-            move_path = os.path.join(download_path, s3obj.key)
-            if not os.path.exists(os.path.dirname(move_path)):
-                os.makedirs(os.path.dirname(move_path), exist_ok=True)
-            shutil.move(s3obj.path, os.path.join(download_path, s3obj.key))
-
-def download(download_path, store_key=""):
+def list_remote(client, store_key, download_path):
+    """
+    Returns a list of (key, local path, size, etag) for every object of a sample.
+    Single files (.csv/.pkl) map to one object, directories to every object under the prefix.
+    """
+    bucket = S3_ROOT.replace("s3://", "").strip("/")
     if download_path.endswith(".csv") or download_path.endswith(".pkl"):
-        with S3(s3root=S3_ROOT, role=S3_ROLE) as s3:
-            obj = s3.get(store_key)
-            with open(download_path, "wb") as f:
-                f.write(obj.blob)
-    else:
-        _download_directory(download_path, store_key)
+        head = client.head_object(Bucket=bucket, Key=store_key)
+        return [(store_key, download_path, head["ContentLength"], head["ETag"].strip('"'))]
+    objects = []
+    prefix = store_key.rstrip("/") + "/"
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects.append(
+                (
+                    obj["Key"],
+                    os.path.join(download_path, obj["Key"][len(prefix):]),
+                    obj["Size"],
+                    obj["ETag"].strip('"'),
+                )
+            )
+    return objects
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fetch_object(client, key, path, size, etag, on_bytes):
+    """
+    Stream one object to path, resuming from a previous partial download with a ranged GET.
+    Data goes to path.part and is only renamed to path once its size, and its md5 for
+    single-part uploads, match the remote listing. Multipart ETags are not an md5 of the
+    content, those objects are verified by size only, so every GET is conditional on the
+    listed ETag: if the object changed since, the partial download is dropped and the new
+    version is fetched from the start.
+    """
+    from botocore.exceptions import ClientError
+
+    bucket = S3_ROOT.replace("s3://", "").strip("/")
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        on_bytes(size)
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part_path = path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size:
+        offset = 0
+    on_bytes(offset)
+    if offset < size:
+        try:
+            response = client.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={offset}-", IfMatch=f'"{etag}"'
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("PreconditionFailed", "412"):
+                raise
+            if offset:
+                os.remove(part_path)
+                on_bytes(-offset)
+            head = client.head_object(Bucket=bucket, Key=key)
+            return fetch_object(
+                client, key, path, head["ContentLength"], head["ETag"].strip('"'), on_bytes
+            )
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in response["Body"].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                on_bytes(len(chunk))
+    elif not os.path.exists(part_path):
+        # empty object
+        open(part_path, "wb").close()
+    if os.path.getsize(part_path) != size:
+        raise IOError(f"Size mismatch for {key}: expected {size}, got {os.path.getsize(part_path)}")
+    if "-" not in etag and _md5(part_path) != etag:
+        os.remove(part_path)
+        raise IOError(f"Checksum mismatch for {key}, the partial download was removed")
+    os.replace(part_path, path)
+
+
+def download_all(samples, data_dir="data", workers=DOWNLOAD_WORKERS):
+    """
+    Download every sample concurrently, reporting aggregate progress and throughput.
+    Files that are already complete are skipped, partial ones are resumed.
+    """
+    # the pooled client of the shared datastore, sized for concurrent transfers
+    client = get_backend(S3_ROOT, role=S3_ROLE).client
+    objects = []
+    for data_path in samples:
+        objects += list_remote(
+            client,
+            store_key=os.path.join(S3_DATA_KEY, data_path),
+            download_path=os.path.join(data_dir, data_path),
+        )
+    lock = threading.Lock()
+    with Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeRemainingColumn(),
+    ) as progress:
+        task = progress.add_task(
+            f"Downloading {len(samples)} samples ({len(objects)} objects)...",
+            total=sum(obj[2] for obj in objects),
+        )
+
+        def on_bytes(n):
+            with lock:
+                progress.update(task, advance=n)
+
+        with ThreadPoolExecutor(workers) as pool:
+            futures = {
+                pool.submit(fetch_object, client, key, path, size, etag, on_bytes): key
+                for key, path, size, etag in objects
+            }
+            failed = []
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    progress.console.print(f"Failed to download {futures[future]}: {e}")
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} objects failed to download, run again to resume them."
+        )
 
 def run_command(command: str, progress: Progress = None):
     process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -120,27 +249,12 @@ def main(conda_env_name: str = DEFAULT_CONDA_ENV_NAME):
         default="n"
     )
 
+    samples = list(DATASET_SAMPLES)
     if big_data_response == "y":
-        DATASET_SAMPLES.append("genecorpus_30M_2048.dataset")
+        samples += BIG_DATASET_SAMPLES
 
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        transient=True,
-    ) as progress:
-        taskData = progress.add_task("Downloading data...", total=None)
-        if not os.path.exists("data"):
-            os.makedirs("data")
-        for data_path in DATASET_SAMPLES:
-            if not os.path.exists(os.path.join("data", data_path)):
-                progress.console.print(f"Downloading {data_path}...")
-                download(
-                    download_path=os.path.join("data", data_path), 
-                    store_key=os.path.join(S3_DATA_KEY, data_path)
-                )
-            else:
-                progress.console.print(f"Skipping {data_path}, already downloaded.")
-        progress.update(taskData, completed=True)
+    print("Downloading data...")
+    download_all(samples, data_dir="data")
     
 
 if __name__ == "__main__":
@@ -0,0 +1,998 @@
+"""
+Datastore shared by the flows in this repository.
+
+Each flow directory links to this module, so `from datastore import DataStore` works
+both locally and in the code package Metaflow ships to remote tasks. Transfers go through
+a backend: S3Backend keeps one pooled client per process for every step, LocalBackend
+stores everything in a local directory for tests and air-gapped runs.
+
+Set DATASTORE_ROOT to an s3:// url or a local directory to override the Metaflow
+datatools root.
+"""
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from tempfile import TemporaryDirectory
+
+try:
+    from metaflow.metaflow_config import DATATOOLS_S3ROOT
+except ImportError:
+    # a local DATASTORE_ROOT works without Metaflow, e.g. in tests
+    DATATOOLS_S3ROOT = None
+
+# store root, an s3:// url selects S3Backend and anything else LocalBackend
+DATASTORE_ROOT = os.environ.get("DATASTORE_ROOT") or DATATOOLS_S3ROOT
+# local download cache, opt-in: a directory on the node where downloaded objects are kept
+# and reused across runs and tasks (keyed by object ETag and size)
+DATASTORE_CACHE_DIR = os.environ.get("DATASTORE_CACHE_DIR")
+# eviction budget for the download cache, least recently used objects are removed first
+DATASTORE_CACHE_MAX_BYTES = int(os.environ.get("DATASTORE_CACHE_MAX_BYTES", 100 * 2**30))
+# objects transferred concurrently, and concurrent part requests within each large object
+DATASTORE_WORKERS = int(os.environ.get("DATASTORE_WORKERS", 16))
+DATASTORE_PART_CONCURRENCY = int(os.environ.get("DATASTORE_PART_CONCURRENCY", 4))
+# connections kept open by the pooled S3 client, enough for every worker's part requests
+DATASTORE_MAX_POOL_CONNECTIONS = DATASTORE_WORKERS * DATASTORE_PART_CONCURRENCY
+# target size of the Arrow shards written by upload_hf_dataset
+HF_SHARD_BYTES = 500 * 2**20  # 500MB, same as datasets.save_to_disk
+# shards written but not yet uploaded, bounds local disk use to about (N + 1) * HF_SHARD_BYTES
+HF_UPLOAD_MAX_IN_FLIGHT = 4
+# compression applied to uploaded files, None (default), "zstd" or "lz4"
+DATASTORE_CODEC = os.environ.get("DATASTORE_CODEC") or None
+DATASTORE_ZSTD_LEVEL = int(os.environ.get("DATASTORE_ZSTD_LEVEL", 3))
+
+# ioctl request number for FICLONE (copy-on-write clone on btrfs/xfs)
+_FICLONE = 0x40049409
+# manifest object written under every uploaded store key, records size and md5 per file
+MANIFEST_NAME = ".datastore_manifest.json"
+# object metadata key recording the codec of a compressed object
+CODEC_METADATA_KEY = "datastore-codec"
+# per-process memo of positive existence checks and non-empty listings, keyed by the full
+# store url. Missing keys are always checked again, another task may have written them since.
+_EXISTS_MEMO = {}
+_LISTING_MEMO = {}
+
+
+def _file_md5(path, chunk_size=8 * 2**20):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _encode_file(src, dst, codec):
+    "Compress src into dst, zstd uses every core."
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        if codec == "zstd":
+            import zstandard
+
+            zstandard.ZstdCompressor(level=DATASTORE_ZSTD_LEVEL, threads=-1).copy_stream(
+                fin, fout
+            )
+        elif codec == "lz4":
+            import lz4.frame
+
+            with lz4.frame.LZ4FrameFile(fout, "wb") as writer:
+                shutil.copyfileobj(fin, writer, 8 * 2**20)
+        else:
+            raise ValueError(f"Unknown datastore codec {codec}, use zstd or lz4")
+
+
+def _decode_stream(stream, dst, codec):
+    "Decompress a readable stream into dst as it is read."
+    with open(dst, "wb") as fout:
+        if codec == "zstd":
+            import zstandard
+
+            zstandard.ZstdDecompressor().copy_stream(stream, fout)
+        elif codec == "lz4":
+            import lz4.frame
+
+            with lz4.frame.LZ4FrameFile(stream, "rb") as reader:
+                shutil.copyfileobj(reader, fout, 8 * 2**20)
+        else:
+            raise ValueError(f"Unknown datastore codec {codec}, use zstd or lz4")
+
+
+def _link_or_copy(src, dst):
+    "Materialize src at dst as a hardlink, falling back to a reflink and then a plain copy."
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+class S3Backend:
+    """
+    Objects under an s3:// root, transferred with a boto3 client that is created once
+    per process and role and shared by every DataStore call and worker thread.
+    """
+
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, root, role=None):
+        parsed = urlparse(root)
+        self.root = root
+        self.role = role
+        self._bucket = parsed.netloc
+        self._prefix = parsed.path.strip("/")
+
+    @property
+    def client(self):
+        from botocore.config import Config
+        from metaflow.plugins.datatools.s3.s3util import get_s3_client
+
+        # boto3 clients are thread-safe but must not cross a fork
+        client_key = (os.getpid(), self.role)
+        with self._clients_lock:
+            if client_key not in self._clients:
+                client, _ = get_s3_client(
+                    s3_role_arn=self.role,
+                    s3_client_params={
+                        "config": Config(
+                            max_pool_connections=DATASTORE_MAX_POOL_CONNECTIONS,
+                            retries={"max_attempts": 10, "mode": "adaptive"},
+                        )
+                    },
+                )
+                self._clients[client_key] = client
+            return self._clients[client_key]
+
+    @property
+    def _transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(max_concurrency=DATASTORE_PART_CONCURRENCY)
+
+    def _key(self, key):
+        return "/".join(part for part in [self._prefix, key.strip("/")] if part)
+
+    def url(self, key):
+        return os.path.join(self.root, key)
+
+    def iter_objects(self, prefix):
+        "Yield (key relative to prefix, {size, etag}) for every object, page by page."
+        full_prefix = self._key(prefix) + "/"
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=full_prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(full_prefix) :], {
+                    "size": obj["Size"],
+                    "etag": obj["ETag"].strip('"'),
+                }
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self._bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def get_bytes(self, key):
+        "Object content, or None if it does not exist."
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.get_object(Bucket=self._bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self._bucket, Key=self._key(key), Body=data)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self._bucket, Key=self._key(key))
+
+    def open_stream(self, key):
+        return self.client.get_object(Bucket=self._bucket, Key=self._key(key))["Body"]
+
+    def get_file(self, key, path):
+        # download_file writes to a temporary file next to path and renames it,
+        # so there is no staging copy and no partially written destination
+        self.client.download_file(
+            self._bucket, self._key(key), path, Config=self._transfer_config
+        )
+
+    def put_file(self, path, key, metadata=None):
+        self.client.upload_file(
+            path,
+            self._bucket,
+            self._key(key),
+            ExtraArgs={"Metadata": metadata} if metadata else None,
+            Config=self._transfer_config,
+        )
+
+
+class LocalBackend:
+    """
+    Objects stored as files under a local directory, for tests and air-gapped runs.
+    The ETag reported by listings is derived from size and modification time.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key.strip("/"))
+
+    def url(self, key):
+        return self._path(key)
+
+    def iter_objects(self, prefix):
+        base = self._path(prefix)
+        for path, _, files in os.walk(base):
+            for name in files:
+                full_path = os.path.join(path, name)
+                stat = os.stat(full_path)
+                yield os.path.relpath(full_path, base), {
+                    "size": stat.st_size,
+                    "etag": f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+                }
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get_bytes(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _atomic_copy(self, src, dst):
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+    def put_bytes(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def open_stream(self, key):
+        return open(self._path(key), "rb")
+
+    def get_file(self, key, path):
+        self._atomic_copy(self._path(key), path)
+
+    def put_file(self, path, key, metadata=None):
+        # metadata is not stored, codecs are also recorded in the upload manifest
+        self._atomic_copy(path, self._path(key))
+
+
+_BACKENDS = {}
+
+
+def get_backend(root=DATASTORE_ROOT, role=None):
+    "Backend for a store root, created once per process."
+    if (root, role) not in _BACKENDS:
+        if root.startswith("s3://"):
+            _BACKENDS[(root, role)] = S3Backend(root, role=role)
+        else:
+            _BACKENDS[(root, role)] = LocalBackend(root)
+    return _BACKENDS[(root, role)]
+
+
+class DownloadCache:
+    """
+    Content-addressed, node-local cache of objects downloaded from the store.
+
+    Objects live once under `objects/`, keyed by their ETag and size, and a manifest per
+    store key records which objects made up that prefix and the hash of its upload
+    manifest, so an unchanged prefix is downloaded again without listing it. Cached files
+    are hardlinked (or reflinked) into the download path, so consumers must treat them as
+    read-only.
+    Least recently used objects are evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DATASTORE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._objects_dir = os.path.join(cache_dir, "objects")
+        self._manifests_dir = os.path.join(cache_dir, "manifests")
+        os.makedirs(self._objects_dir, exist_ok=True)
+        os.makedirs(self._manifests_dir, exist_ok=True)
+
+    def object_path(self, etag, size):
+        digest = hashlib.sha256(f"{etag}:{size}".encode()).hexdigest()
+        return os.path.join(self._objects_dir, digest[:2], digest)
+
+    def _manifest_path(self, store_url):
+        digest = hashlib.sha256(store_url.encode()).hexdigest()
+        return os.path.join(self._manifests_dir, f"{digest}.json")
+
+    def lookup(self, etag, size, cached_size=None):
+        """
+        Return the cached path for an object, or None on a miss. Compressed objects are
+        cached decompressed, pass their decompressed size as cached_size.
+        """
+        path = self.object_path(etag, size)
+        try:
+            if os.path.getsize(path) != (size if cached_size is None else cached_size):
+                return None
+            # bump the modification time, it is the recency signal used for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def read_manifest(self, store_url):
+        "The manifest written by write_manifest for store_url, or None."
+        try:
+            with open(self._manifest_path(store_url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, store_url, objects, upload_manifest_md5=None):
+        path = self._manifest_path(store_url)
+        with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(
+                {
+                    "store_url": store_url,
+                    "objects": objects,
+                    "upload_manifest_md5": upload_manifest_md5,
+                },
+                f,
+            )
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def evict(self, keep=()):
+        "Remove least recently used objects until the cache fits in the byte budget."
+        entries = []
+        total = 0
+        for path, _, files in os.walk(self._objects_dir):
+            for name in files:
+                full_path = os.path.join(path, name)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, full_path))
+                total += stat.st_size
+        keep = set(keep)
+        for _, size, full_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if full_path in keep:
+                continue
+            try:
+                os.remove(full_path)
+            except OSError:
+                continue
+            total -= size
+        return total
+
+
+class DataStore:
+
+    _store_root = DATASTORE_ROOT
+    _store_role = None
+    _cache_dir = DATASTORE_CACHE_DIR
+    _codec = DATASTORE_CODEC
+
+    @property
+    def root(self):
+        return self._store_root
+
+    @property
+    def backend(self):
+        return get_backend(self._store_root, self._store_role)
+
+    def _url(self, store_key=""):
+        return self.backend.url(store_key)
+
+    @staticmethod
+    def _walk_directory(root):
+        path_keys = []
+        for path, subdirs, files in os.walk(root):
+            for name in files:
+                # create a tuple of (key, path)
+                path_keys.append(
+                    (
+                        os.path.relpath(os.path.join(path, name), root),
+                        os.path.join(path, name),
+                    )
+                )
+        return path_keys
+
+    def _put_encoded(self, path, key, codec=None):
+        "Upload a file, compressing it first when a codec is given."
+        if codec is None:
+            self.backend.put_file(path, key)
+            return
+        with TemporaryDirectory() as temp_dir:
+            encoded_path = os.path.join(temp_dir, os.path.basename(path))
+            _encode_file(path, encoded_path, codec)
+            self.backend.put_file(
+                encoded_path, key, metadata={CODEC_METADATA_KEY: codec}
+            )
+
+    def _get_decoded(self, key, path, codec=None):
+        "Download an object to path, decompressing it while it streams in."
+        if codec is None:
+            self.backend.get_file(key, path)
+            return
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with closing(self.backend.open_stream(key)) as stream:
+            _decode_stream(stream, tmp_path, codec)
+        os.replace(tmp_path, path)
+
+    def _upload_directory(self, local_path, store_key="", delta=False, codec=None):
+        return self._upload_files(
+            self._walk_directory(local_path), store_key, delta, codec
+        )
+
+    def _upload_files(self, path_keys, store_key="", delta=False, codec=None):
+        """
+        Put (key, path) pairs under store_key and write the upload manifest.
+        In delta mode, files whose size and md5 match the remote copy are skipped, and
+        remote objects of files that no longer exist locally are deleted.
+        Sizes and md5s in the manifest are those of the uncompressed files.
+        """
+        codec = codec or self._codec
+        remote = self._remote_file_state(store_key) if delta else {}
+        files = {}
+        to_send = []
+        stats = {
+            "files_sent": 0,
+            "bytes_sent": 0,
+            "files_skipped": 0,
+            "bytes_skipped": 0,
+            "files_deleted": 0,
+        }
+        for key, path in path_keys:
+            size = os.path.getsize(path)
+            files[key] = {"size": size, "md5": _file_md5(path)}
+            if codec is not None:
+                files[key]["codec"] = codec
+            previous = remote.get(key)
+            if previous is not None and previous == files[key]:
+                stats["files_skipped"] += 1
+                stats["bytes_skipped"] += size
+            else:
+                to_send.append((key, path))
+                stats["files_sent"] += 1
+                stats["bytes_sent"] += size
+        with ThreadPoolExecutor(DATASTORE_WORKERS) as pool:
+            futures = [
+                pool.submit(self._put_encoded, path, os.path.join(store_key, key), codec)
+                for key, path in to_send
+            ]
+            for future in futures:
+                future.result()
+        self._put_manifest(store_key, files)
+        if delta:
+            # the new manifest no longer lists them, remove them so downloads match it
+            stale = [
+                key
+                for key, _ in self.backend.iter_objects(store_key)
+                if key not in files and key != MANIFEST_NAME
+            ]
+            with ThreadPoolExecutor(DATASTORE_WORKERS) as pool:
+                for future in [
+                    pool.submit(self.backend.delete, os.path.join(store_key, key))
+                    for key in stale
+                ]:
+                    future.result()
+            stats["files_deleted"] = len(stale)
+            self._forget_listings(store_key)
+            print(
+                f"Delta upload to {store_key}: sent {stats['files_sent']} files "
+                f"({stats['bytes_sent'] / 2**20:.1f}MB), skipped {stats['files_skipped']} "
+                f"unchanged files ({stats['bytes_skipped'] / 2**20:.1f}MB), "
+                f"deleted {stats['files_deleted']} removed files"
+            )
+        return stats
+
+    def _put_manifest(self, store_key, files):
+        # the manifest goes last, so its presence marks the upload as complete
+        self.backend.put_bytes(
+            os.path.join(store_key, MANIFEST_NAME),
+            json.dumps({"files": files, "created": time.time()}),
+        )
+        self._forget_listings(store_key)
+        _EXISTS_MEMO[self._url(store_key)] = True
+
+    def _forget_listings(self, store_key=""):
+        "Drop the memoized listings of store_key and of every prefix containing it."
+        url = self._url(store_key).rstrip("/")
+        for listed_url in list(_LISTING_MEMO):
+            prefix = listed_url.rstrip("/")
+            if url == prefix or url.startswith(prefix + "/"):
+                _LISTING_MEMO.pop(listed_url, None)
+
+    def _read_manifest(self, store_key=""):
+        data = self.backend.get_bytes(os.path.join(store_key, MANIFEST_NAME))
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def _remote_file_state(self, store_key=""):
+        """
+        Size and md5 of every file under store_key, read from the upload manifest.
+        Prefixes uploaded without a manifest fall back to the listing, where single-part
+        ETags are the md5 of the object and multipart ETags never match.
+        """
+        manifest = self._read_manifest(store_key)
+        if manifest is not None:
+            return manifest["files"]
+        return {
+            key: {"size": info["size"], "md5": info["etag"]}
+            for key, info in self._list_objects(store_key).items()
+            if "-" not in info["etag"]
+        }
+
+    def fingerprint(self, store_key=""):
+        """
+        Content fingerprint of everything stored under store_key, from the sizes and md5s in
+        the upload manifest, or the sizes and ETags of the listing for data uploaded without one.
+        """
+        manifest = self._read_manifest(store_key)
+        if manifest is not None:
+            files = {k: [v["size"], v["md5"]] for k, v in manifest["files"].items()}
+        else:
+            files = {k: [v["size"], v["etag"]] for k, v in self._list_objects(store_key).items()}
+        return hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+
+    def put_json(self, store_key, obj):
+        "Store a small JSON document at store_key."
+        self.backend.put_bytes(store_key, json.dumps(obj))
+        self._forget_listings(store_key)
+
+    def get_json(self, store_key):
+        "Read a JSON document stored with put_json, or None if there is none."
+        data = self.backend.get_bytes(store_key)
+        return None if data is None else json.loads(data)
+
+    def _list_objects(self, store_key=""):
+        """
+        Parameters
+        ----------
+        store_key : str
+            Key suffixed to the store_root to list the store contents of.
+
+        Returns
+        -------
+        dict
+            Maps each object key, relative to store_key, to its size and ETag.
+            Non-empty listings are memoized for the lifetime of the process.
+        """
+        return dict(self._iter_objects(store_key))
+
+    def _iter_objects(self, store_key=""):
+        """
+        Yield (key, info) pairs page by page as the listing comes in, so consumers can
+        start working before the prefix is fully listed. A completed, non-empty listing
+        is memoized.
+        """
+        final_path = self._url(store_key)
+        if final_path in _LISTING_MEMO:
+            yield from _LISTING_MEMO[final_path].items()
+            return
+        objects = {}
+        for key, info in self.backend.iter_objects(store_key):
+            objects[key] = info
+            yield key, info
+        if objects:
+            _LISTING_MEMO[final_path] = objects
+
+    def _fetch_objects(self, store_key, objects, destination):
+        """
+        Download objects straight to their final paths with bounded concurrency.
+
+        Parameters
+        ----------
+        store_key : str
+            Key suffixed to the store_root the object keys are relative to.
+        objects : iterable
+            (key, info) pairs, e.g. from _iter_objects. Fetches start while it is consumed.
+            Objects whose info has a codec are decompressed while they stream in.
+        destination : callable
+            Maps (key, info) to the local path to write, or None to skip the object.
+
+        Returns
+        -------
+        int
+            Number of bytes downloaded.
+        """
+        created_dirs = set()
+        futures = []
+        total_bytes = 0
+        start = time.time()
+        with ThreadPoolExecutor(DATASTORE_WORKERS) as pool:
+            for key, info in objects:
+                path = destination(key, info)
+                if path is None:
+                    continue
+                directory = os.path.dirname(path)
+                if directory not in created_dirs:
+                    os.makedirs(directory, exist_ok=True)
+                    created_dirs.add(directory)
+                futures.append(
+                    pool.submit(
+                        self._get_decoded,
+                        os.path.join(store_key, key),
+                        path,
+                        info.get("codec"),
+                    )
+                )
+                total_bytes += info["size"]
+            for future in futures:
+                future.result()
+        elapsed = max(time.time() - start, 1e-6)
+        print(
+            f"Downloaded {len(futures)} objects from {store_key} "
+            f"({total_bytes / 2**20:.1f}MB in {elapsed:.1f}s, {total_bytes / 2**20 / elapsed:.1f}MB/s)"
+        )
+        return total_bytes
+
+    def _iter_objects_with_codecs(self, store_key="", manifest=None):
+        "Listing with the codec of each object added from the upload manifest."
+        manifest = manifest or self._read_manifest(store_key) or {"files": {}}
+        for key, info in self._iter_objects(store_key):
+            entry = manifest["files"].get(key, {})
+            if entry.get("codec"):
+                yield key, dict(info, codec=entry["codec"], decoded_size=entry["size"])
+            else:
+                yield key, info
+
+    def already_exists(self, store_key=""):
+        """
+        Check for the upload manifest with a single HEAD request, only listing the
+        prefix for data uploaded without one. Keys found are memoized per process, missing
+        ones are checked again on every call.
+        """
+        final_path = self._url(store_key)
+        if final_path in _EXISTS_MEMO:
+            return True
+        exists = self.backend.exists(os.path.join(store_key, MANIFEST_NAME))
+        if not exists:
+            exists = len(self._list_objects(store_key)) > 0
+        if exists:
+            _EXISTS_MEMO[final_path] = True
+        return exists
+
+    def _download_directory(self, download_path, store_key=""):
+        """
+        Parameters
+        ----------
+        download_path : str
+            Path to the folder where the store contents will be downloaded
+        store_key : str
+            Key suffixed to the store_root to save the store contents to
+        """
+        os.makedirs(download_path, exist_ok=True)
+        if self._cache_dir:
+            self._download_directory_cached(download_path, store_key)
+            return
+
+        def destination(key, info):
+            if key == MANIFEST_NAME:
+                return None
+            return os.path.join(download_path, key)
+
+        self._fetch_objects(
+            store_key, self._iter_objects_with_codecs(store_key), destination
+        )
+
+    def _download_directory_cached(self, download_path, store_key=""):
+        """
+        Download through the node-local DownloadCache, only fetching objects whose
+        ETag and size are not cached yet. If the upload manifest is unchanged since the
+        last download of store_key on this node, its objects are taken from the cache
+        manifest instead of listing the prefix.
+        """
+        cache = DownloadCache(self._cache_dir)
+        store_url = self._url(store_key)
+        upload_manifest = self.backend.get_bytes(os.path.join(store_key, MANIFEST_NAME))
+        upload_manifest_md5 = None
+        listing = None
+        if upload_manifest is not None:
+            upload_manifest_md5 = hashlib.md5(upload_manifest).hexdigest()
+            cached = cache.read_manifest(store_url)
+            if cached is not None and cached.get("upload_manifest_md5") == upload_manifest_md5:
+                listing = cached["objects"].items()
+        if listing is None:
+            listing = self._iter_objects_with_codecs(
+                store_key, upload_manifest and json.loads(upload_manifest)
+            )
+
+        objects = {}
+        misses = []
+        hit_bytes = 0
+
+        def link(key, info):
+            link_path = os.path.join(download_path, key)
+            os.makedirs(os.path.dirname(link_path), exist_ok=True)
+            _link_or_copy(cache.object_path(info["etag"], info["size"]), link_path)
+
+        def destination(key, info):
+            nonlocal hit_bytes
+            if key == MANIFEST_NAME:
+                return None
+            objects[key] = info
+            if cache.lookup(info["etag"], info["size"], info.get("decoded_size")) is not None:
+                # linked right away, so a concurrent evict can no longer remove it first
+                try:
+                    link(key, info)
+                    hit_bytes += info["size"]
+                    return None
+                except FileNotFoundError:
+                    pass
+            # misses are written straight into the cache and linked below
+            misses.append(key)
+            return cache.object_path(info["etag"], info["size"])
+
+        fetched_bytes = self._fetch_objects(store_key, listing, destination)
+        for key in misses:
+            link(key, objects[key])
+        cache.write_manifest(store_url, objects, upload_manifest_md5)
+        cache.evict(
+            keep=[cache.object_path(i["etag"], i["size"]) for i in objects.values()]
+        )
+        print(
+            f"Download cache for {store_key}: reused {hit_bytes / 2**20:.1f}MB, "
+            f"fetched {fetched_bytes / 2**20:.1f}MB"
+        )
+
+    def upload(self, local_path, store_key="", delta=False, codec=None):
+        """
+        Parameters
+        ----------
+        local_path : str
+            Path to the store contents to be saved in cloud object storage.
+        store_key : str
+            Key suffixed to the store_root to save the store contents to.
+        delta : bool
+            Only send files that are new or changed compared to what is already stored
+            under store_key.
+        codec : str
+            Compress files with "zstd" or "lz4" before sending them, defaults to
+            DATASTORE_CODEC. Downloads decompress them transparently.
+
+        Returns
+        -------
+        dict
+            Number of files and bytes sent and skipped.
+        """
+        if os.path.isdir(local_path):
+            return self._upload_directory(local_path, store_key, delta, codec)
+        return self._upload_files(
+            [(local_path.lstrip("/"), local_path)], store_key, delta, codec
+        )
+
+    def download(self, download_path, store_key=""):
+        """
+        Parameters
+        ----------
+        store_key : str
+            Key suffixed to the store_root to download the store contents from
+        download_path : str
+            Path to the folder where the store contents will be downloaded
+        """
+        if not self.already_exists(store_key):
+            raise ValueError(
+                f"Model with key {store_key} does not exist in {self._store_root}"
+            )
+        self._download_directory(download_path, store_key)
+
+    def download_file(self, download_path, store_key=""):
+        """
+        Parameters
+        ----------
+        store_key : str
+            Key the single file was uploaded to with `upload`
+        download_path : str
+            Path to the file where the store contents will be downloaded
+        """
+        objects = [
+            (key, info)
+            for key, info in self._iter_objects_with_codecs(store_key)
+            if key != MANIFEST_NAME
+        ]
+        if len(objects) != 1:
+            raise ValueError(
+                f"Expected a single file under {store_key} in {self._store_root}, found {len(objects)}"
+            )
+        key, info = objects[0]
+        os.makedirs(os.path.dirname(download_path) or ".", exist_ok=True)
+        self._get_decoded(os.path.join(store_key, key), download_path, info.get("codec"))
+
+    def upload_hf_dataset(
+        self,
+        dataset,
+        store_key="",
+        shard_bytes=HF_SHARD_BYTES,
+        max_in_flight=HF_UPLOAD_MAX_IN_FLIGHT,
+        batch_rows=1000,
+        codec=None,
+    ):
+        """
+        Stream the dataset into Arrow shards and upload each shard as soon as it is
+        finalized, with at most max_in_flight shards on local disk at any time.
+        The stored layout is the one written by `Dataset.save_to_disk`, so it can be
+        read with `load_from_disk` after download.
+
+        Parameters
+        ----------
+        dataset : datasets.Dataset
+            Huggingface dataset to be saved in cloud object storage.
+        store_key : str
+            Key suffixed to the store_root to save the store contents to.
+        shard_bytes : int
+            Approximate size of each Arrow shard.
+        max_in_flight : int
+            Number of shards uploading concurrently.
+        batch_rows : int
+            Rows read from the dataset and written to a shard at a time.
+        codec : str
+            Compress shards with "zstd" or "lz4", defaults to DATASTORE_CODEC.
+        """
+        import pyarrow as pa
+
+        num_rows = len(dataset)
+        # the shard count is part of every shard file name, so estimate it up front
+        # from the size of the underlying table scaled to the selected rows
+        nbytes = dataset.data.nbytes * num_rows / max(dataset.data.num_rows, 1)
+        num_shards = max(1, min(math.ceil(nbytes / shard_bytes), num_rows))
+        rows_per_shard = math.ceil(num_rows / num_shards)
+        schema = dataset.features.arrow_schema
+        arrow_dataset = dataset.with_format("arrow")
+
+        codec = codec or self._codec
+
+        def put_shard(name, path):
+            self._put_encoded(path, os.path.join(store_key, name), codec)
+            os.remove(path)
+
+        files = {}
+        shard_names = []
+        start = time.time()
+        with TemporaryDirectory() as temp_dir, ThreadPoolExecutor(max_in_flight) as pool:
+            pending = set()
+            for shard_idx in range(num_shards):
+                name = f"data-{shard_idx:05d}-of-{num_shards:05d}.arrow"
+                path = os.path.join(temp_dir, name)
+                shard_start = shard_idx * rows_per_shard
+                shard_end = min(shard_start + rows_per_shard, num_rows)
+                with pa.OSFile(path, "wb") as sink, pa.ipc.new_stream(sink, schema) as writer:
+                    for batch_start in range(shard_start, shard_end, batch_rows):
+                        table = arrow_dataset[batch_start : min(batch_start + batch_rows, shard_end)]
+                        writer.write_table(table.replace_schema_metadata(schema.metadata))
+                files[name] = {
+                    "size": os.path.getsize(path),
+                    "md5": _file_md5(path),
+                    "num_rows": shard_end - shard_start,
+                }
+                if codec is not None:
+                    files[name]["codec"] = codec
+                shard_names.append(name)
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(pool.submit(put_shard, name, path))
+            for future in pending:
+                future.result()
+
+            # the same metadata files save_to_disk writes next to the shards
+            state = {
+                key: dataset.__dict__[key]
+                for key in [
+                    "_fingerprint",
+                    "_format_columns",
+                    "_format_kwargs",
+                    "_format_type",
+                    "_output_all_columns",
+                ]
+            }
+            state["_split"] = str(dataset.split) if dataset.split is not None else None
+            state["_data_files"] = [{"filename": name} for name in shard_names]
+            with open(os.path.join(temp_dir, "state.json"), "w") as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            dataset.info.write_to_directory(temp_dir)
+            for name in os.listdir(temp_dir):
+                if name in files:
+                    continue
+                path = os.path.join(temp_dir, name)
+                files[name] = {"size": os.path.getsize(path), "md5": _file_md5(path)}
+                self.backend.put_file(path, os.path.join(store_key, name))
+            self._put_manifest(store_key, files)
+        total_bytes = sum(f["size"] for f in files.values())
+        print(
+            f"Uploaded {num_rows} rows to {store_key} in {num_shards} shards "
+            f"({total_bytes / 2**20:.1f}MB, {total_bytes / 2**20 / max(time.time() - start, 1e-6):.1f}MB/s)"
+        )
+
+    def _hf_shards(self, store_key=""):
+        """
+        (name, info) of the Arrow shards of a dataset stored with upload_hf_dataset, in row
+        order, with each shard's num_rows. None if store_key holds no such dataset.
+        """
+        manifest = self._read_manifest(store_key)
+        if manifest is None:
+            return None
+        shards = sorted(
+            (name, info) for name, info in manifest["files"].items() if "num_rows" in info
+        )
+        return shards or None
+
+    def download_hf_dataset_rows(self, download_path, start=0, stop=None, store_key=""):
+        """
+        Download only the Arrow shards holding rows start to stop of a dataset stored with
+        upload_hf_dataset, and return those rows as a memory-mapped datasets.Dataset.
+
+        Parameters
+        ----------
+        download_path : str
+            Local directory the shards are written to.
+        start, stop : int
+            Row range to return, stop defaults to the end of the dataset.
+        store_key : str
+            Key suffixed to the store_root the dataset is stored under.
+        """
+        from datasets import Dataset, concatenate_datasets
+
+        shards = self._hf_shards(store_key)
+        if shards is None:
+            raise ValueError(
+                f"No shard row counts for {store_key}, upload it with DataStore.upload_hf_dataset"
+            )
+        num_rows = sum(info["num_rows"] for _, info in shards)
+        stop = num_rows if stop is None else min(stop, num_rows)
+        if not 0 <= start < stop:
+            raise ValueError(f"Empty row range {start}:{stop} of {store_key} ({num_rows} rows)")
+
+        selected = []
+        offset = 0
+        for name, info in shards:
+            if offset < stop and offset + info["num_rows"] > start:
+                if not selected:
+                    first_row = offset
+                selected.append((name, info))
+            offset += info["num_rows"]
+        self._fetch_objects(
+            store_key, selected, lambda key, info: os.path.join(download_path, key)
+        )
+        dataset = concatenate_datasets(
+            [Dataset.from_file(os.path.join(download_path, name)) for name, _ in selected]
+        )
+        return dataset.select(range(start - first_row, stop - first_row))
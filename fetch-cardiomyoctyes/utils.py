@@ -1,109 +1,11 @@
-from metaflow.metaflow_config import DATATOOLS_S3ROOT
-from metaflow import S3
 import os
-import shutil
 import subprocess
 from config import *
-from tempfile import TemporaryDirectory
 import numpy as np
+import datastore
 
 
-class DataStore:
-
-    _store_root = DATATOOLS_S3ROOT
-
-    @property
-    def root(self):
-        return self._store_root
-
-    @staticmethod
-    def _walk_directory(root):
-        path_keys = []
-        for path, subdirs, files in os.walk(root):
-            for name in files:
-                path_keys.append(
-                    (
-                        os.path.relpath(os.path.join(path, name), root),
-                        os.path.join(path, name),
-                    )
-                )
-        return path_keys
-
-    def _upload_directory(self, local_path, store_key=""):
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            s3.put_files(self._walk_directory(local_path))
-
-    def already_exists(self, store_key=""):
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            if len(s3.list_paths()) == 0:
-                return False
-        return True
-
-    def _download_directory(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        download_path : str
-            Path to the folder where the store contents will be downloaded
-        store_key : str
-            Key suffixed to the store_root to save the store contents to
-        """
-        final_path = os.path.join(self._store_root, store_key)
-        os.makedirs(download_path, exist_ok=True)
-        with S3(s3root=final_path) as s3:
-            for s3obj in s3.get_all():
-                move_path = os.path.join(download_path, s3obj.key)
-                if not os.path.exists(os.path.dirname(move_path)):
-                    os.makedirs(os.path.dirname(move_path), exist_ok=True)
-                shutil.move(s3obj.path, os.path.join(download_path, s3obj.key))
-
-    def upload(self, local_path, store_key=""):
-        """
-        Parameters
-        ----------
-        local_path : str
-            Path to the store contents to be saved in cloud object storage.
-        store_key : str
-            Key suffixed to the store_root to save the store contents to.
-        """
-        if os.path.isdir(local_path):
-            self._upload_directory(local_path, store_key)
-        else:
-            final_path = os.path.join(self._store_root, store_key)
-            with S3(s3root=final_path) as s3:
-                s3.put_files([(local_path, local_path)])
-
-    def download(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        store_key : str
-            Key suffixed to the store_root to download the store contents from
-        download_path : str
-            Path to the folder where the store contents will be downloaded
-        """
-        if not self.already_exists(store_key):
-            raise ValueError(
-                f"Model with key {store_key} does not exist in {self._store_root}"
-            )
-        self._download_directory(download_path, store_key)
-
-    def download_file(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        store_key : str
-            Key suffixed to the store_root to download the store contents from
-        download_path : str
-            Path to the file where the store contents will be downloaded
-        """
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            obj = s3.get(store_key)
-            with open(download_path, "wb") as f:
-                f.write(obj.blob)
+class DataStore(datastore.DataStore):
 
     def _install_system_dependencies(self):
         "TODO: move this to docker image"
@@ -0,0 +1 @@
+../datastore.py
\ No newline at end of file
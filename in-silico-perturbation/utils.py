@@ -1,108 +1,8 @@
-from metaflow.metaflow_config import DATATOOLS_S3ROOT
-from metaflow import S3
 import os
-import shutil
 import subprocess
 from config import *
-from tempfile import TemporaryDirectory
-
-
-class DataStore:
-
-    _store_root = DATATOOLS_S3ROOT
-
-    @property
-    def root(self):
-        return self._store_root
-
-    @staticmethod
-    def _walk_directory(root):
-        path_keys = []
-        for path, subdirs, files in os.walk(root):
-            for name in files:
-                # create a tuple of (key, path)
-                path_keys.append(
-                    (
-                        os.path.relpath(os.path.join(path, name), root),
-                        os.path.join(path, name),
-                    )
-                )
-        return path_keys
-
-    def _upload_directory(self, local_path, store_key=""):
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            s3.put_files(self._walk_directory(local_path))
-
-    def already_exists(self, store_key=""):
-        final_path = os.path.join(self._store_root, store_key)
-        with S3(s3root=final_path) as s3:
-            if len(s3.list_paths()) == 0:
-                return False
-        return True
-
-    def _download_directory(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        download_path : str
-            Path to the folder where the store contents will be downloaded
-        store_key : str
-            Key suffixed to the store_root to save the store contents to
-        """
-        final_path = os.path.join(self._store_root, store_key)
-        os.makedirs(download_path, exist_ok=True)
-        with S3(s3root=final_path) as s3:
-            for s3obj in s3.get_all():
-                move_path = os.path.join(download_path, s3obj.key)
-                if not os.path.exists(os.path.dirname(move_path)):
-                    os.makedirs(os.path.dirname(move_path), exist_ok=True)
-                shutil.move(s3obj.path, os.path.join(download_path, s3obj.key))
-
-    def upload(self, local_path, store_key=""):
-        """
-        Parameters
-        ----------
-        local_path : str
-            Path to the store contents to be saved in cloud object storage.
-        store_key : str
-            Key suffixed to the store_root to save the store contents to.
-        """
-        if os.path.isdir(local_path):
-            self._upload_directory(local_path, store_key)
-        else:
-            final_path = os.path.join(self._store_root, store_key)
-            with S3(s3root=final_path) as s3:
-                s3.put_files([(local_path, local_path)])
-
-    def download(self, download_path, store_key=""):
-        """
-        Parameters
-        ----------
-        store_key : str
-            Key suffixed to the store_root to download the store contents from
-        download_path : str
-            Path to the folder where the store contents will be downloaded
-        """
-        if not self.already_exists(store_key):
-            raise ValueError(
-                f"Model with key {store_key} does not exist in {self._store_root}"
-            )
-        self._download_directory(download_path, store_key)
-
-    def upload_hf_dataset(self, dataset, store_key=""):
-        """
-        Parameters
-        ----------
-        dataset : datasets.Dataset
-            Huggingface dataset to be saved in cloud object storage.
-        store_key : str
-            Key suffixed to the store_root to save the store contents to.
-        """
-        with TemporaryDirectory() as temp_dir: 
-            # OK for small data. For big data, use a different method.
-            dataset.save_to_disk(temp_dir)
-            self.upload(temp_dir, store_key)
+from datastore import DataStore
+import modelstore
 
 
 class ModelOps:
@@ -140,7 +40,7 @@ class ModelOps:
 
         state_embs_dict = embex.get_state_embs(
             self.cell_states_to_model,
-            PRETRAINED_MODEL_PATH,
+            modelstore.cached_model_dir(PRETRAINED_MODEL_PATH),
             LOCAL_DATA_DIR,
             OUTPUT_PATH,
             OUTPUT_PREFIX
@@ -180,7 +80,7 @@ class ModelOps:
 
         # outputs intermediate files from in silico perturbation
         isp.perturb_data(
-            PRETRAINED_MODEL_PATH,
+            modelstore.cached_model_dir(PRETRAINED_MODEL_PATH),
             LOCAL_DATA_DIR,
             OUTPUT_PATH,
             OUTPUT_PREFIX
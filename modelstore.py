@@ -0,0 +1,199 @@
+"""
+Node-local model store shared by the flows in this repository.
+
+Checkpoints are converted once to safetensors and kept in a cache directory on the node,
+keyed by the content hash of their weights and config. `from_pretrained` on a cached
+directory memory-maps the weights instead of unpickling `pytorch_model.bin`, so repeated
+loads on a node, from any process, start from the page cache.
+
+Set MODELSTORE_CACHE_DIR to a directory on the node, e.g. a mounted volume, to share the
+cache across tasks. Least recently used models are evicted once the cache grows past
+MODELSTORE_CACHE_MAX_BYTES.
+"""
+import os
+import json
+import shutil
+import hashlib
+from tempfile import mkdtemp
+
+# cache of converted checkpoints, one directory per content hash
+MODELSTORE_CACHE_DIR = os.environ.get(
+    "MODELSTORE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "modelstore")
+)
+# eviction budget for the model cache, least recently used models are removed first
+MODELSTORE_CACHE_MAX_BYTES = int(os.environ.get("MODELSTORE_CACHE_MAX_BYTES", 50 * 2**30))
+
+SAFETENSORS_NAME = "model.safetensors"
+PYTORCH_NAME = "pytorch_model.bin"
+# content hashes of model directories by path, size and mtime of their files
+_HASH_INDEX_NAME = "hash_index.json"
+
+
+def _model_files(model_dir):
+    "Weights and config of a model directory, as (name, path) pairs."
+    if os.path.exists(os.path.join(model_dir, SAFETENSORS_NAME)):
+        names = [SAFETENSORS_NAME, "config.json"]
+    else:
+        names = [PYTORCH_NAME, "config.json"]
+    files = [(name, os.path.join(model_dir, name)) for name in names]
+    for name, path in files:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No {name} in {model_dir}")
+    return files
+
+
+def _read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, _HASH_INDEX_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_index(cache_dir, index):
+    tmp_path = os.path.join(cache_dir, f"{_HASH_INDEX_NAME}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(cache_dir, _HASH_INDEX_NAME))
+
+
+def model_hash(model_dir, cache_dir=MODELSTORE_CACHE_DIR):
+    """
+    Content hash of a model's weights and config. Hashes are remembered by the path,
+    size and mtime of the files, so an unchanged checkpoint is only read once.
+    """
+    files = _model_files(model_dir)
+    stamp = [
+        [os.path.abspath(path), os.stat(path).st_size, os.stat(path).st_mtime_ns]
+        for _, path in files
+    ]
+    index_key = json.dumps(stamp)
+    index = _read_index(cache_dir)
+    if index_key in index:
+        return index[index_key]
+
+    digest = hashlib.sha256()
+    for name, path in files:
+        digest.update(name.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(8 * 2**20), b""):
+                digest.update(chunk)
+    index[index_key] = digest.hexdigest()
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_index(cache_dir, index)
+    return index[index_key]
+
+
+def _write_safetensors(model_dir, output_dir):
+    "Write the weights of a model directory to output_dir/model.safetensors."
+    source = os.path.join(model_dir, SAFETENSORS_NAME)
+    if os.path.exists(source):
+        shutil.copyfile(source, os.path.join(output_dir, SAFETENSORS_NAME))
+        return
+    import torch
+    from safetensors.torch import save_file
+
+    state_dict = torch.load(os.path.join(model_dir, PYTORCH_NAME), map_location="cpu")
+    # safetensors stores no shared tensors, tied weights are re-tied by from_pretrained
+    tensors, seen = {}, set()
+    for name, tensor in state_dict.items():
+        ptr = (tensor.untyped_storage().data_ptr(), tensor.storage_offset())
+        if ptr in seen:
+            continue
+        seen.add(ptr)
+        tensors[name] = tensor.contiguous()
+    save_file(tensors, os.path.join(output_dir, SAFETENSORS_NAME), metadata={"format": "pt"})
+
+
+def evict(cache_dir=MODELSTORE_CACHE_DIR, max_bytes=MODELSTORE_CACHE_MAX_BYTES, keep=()):
+    """
+    Remove least recently used models until the cache fits in max_bytes. Processes that
+    already memory-mapped an evicted model keep reading it. Returns the bytes left.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(".tmp-") or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        entries.append((mtime, size, path))
+        total += size
+    keep = {os.path.abspath(path) for path in keep}
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    return total
+
+
+def cached_model_dir(model_dir, cache_dir=MODELSTORE_CACHE_DIR):
+    """
+    Parameters
+    ----------
+    model_dir : str
+        Directory of a pretrained or finetuned model, with config.json and either
+        model.safetensors or pytorch_model.bin.
+    cache_dir : str
+        Node-local cache of converted models.
+
+    Returns
+    -------
+    str
+        Directory in the cache holding the model as safetensors, with the config and other
+        .json and .txt files (e.g. tokenizer files) of model_dir. It is created on first use; later calls on
+        the node, from any process, return it without reading the weights again.
+    """
+    cached = os.path.join(cache_dir, model_hash(model_dir, cache_dir))
+    if os.path.exists(cached):
+        try:
+            # bump the modification time, it is the recency signal used for eviction
+            os.utime(cached)
+            return cached
+        except FileNotFoundError:
+            # evicted since the check, build it again
+            pass
+
+    # built next to its final location and renamed into place, so readers never see a
+    # partial directory and concurrent builders keep the first complete one
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        for name in os.listdir(model_dir):
+            path = os.path.join(model_dir, name)
+            if os.path.isfile(path) and name.endswith((".json", ".txt")):
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+        _write_safetensors(model_dir, tmp_dir)
+        os.rename(tmp_dir, cached)
+    except OSError:
+        if not os.path.exists(cached):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict(cache_dir, keep=[cached])
+    return cached
+
+
+def load_model(model_cls, model_dir, cache_dir=MODELSTORE_CACHE_DIR, **kwargs):
+    "model_cls.from_pretrained on the cached safetensors copy of model_dir."
+    return model_cls.from_pretrained(
+        cached_model_dir(model_dir, cache_dir), use_safetensors=True, **kwargs
+    )
+
+
+def store_model(model_dir, cache_dir=MODELSTORE_CACHE_DIR):
+    """
+    Convert a saved model directory to safetensors in place, dropping pytorch_model.bin,
+    and add it to the node-local cache. Returns the cached directory.
+    """
+    if not os.path.exists(os.path.join(model_dir, SAFETENSORS_NAME)):
+        _write_safetensors(model_dir, model_dir)
+        os.remove(os.path.join(model_dir, PYTORCH_NAME))
+    return cached_model_dir(model_dir, cache_dir)
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# the shared modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def store(tmp_path):
+    "DataStore on a LocalBackend in a temporary directory."
+    from datastore import DataStore
+
+    datastore = DataStore()
+    datastore._store_root = str(tmp_path / "store")
+    return datastore
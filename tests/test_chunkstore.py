@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+
+from chunkstore import ChunkStore, iter_chunks
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read_tree(root):
+    tree = {}
+    for path, _, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(path, name), "rb") as f:
+                tree[os.path.relpath(os.path.join(path, name), root)] = f.read()
+    return tree
+
+
+def test_round_trip_and_dedup(tmp_path, store):
+    rng = np.random.default_rng(0)
+    local = tmp_path / "checkpoint"
+    write(str(local / "optimizer.pt"), rng.bytes(6 * 2**20))
+    write(str(local / "nested" / "state.json"), b'{"step": 1}')
+    write(str(local / "empty"), b"")
+    chunks = ChunkStore(store, chunks_key="chunks")
+
+    first = chunks.upload(str(local), "run/checkpoint-1")
+    assert first["uploaded_bytes"] == first["unique_bytes"] == first["logical_bytes"]
+    chunks.download(str(tmp_path / "restored"), "run/checkpoint-1")
+    assert read_tree(tmp_path / "restored") == read_tree(local)
+
+    # the same files again send nothing
+    second = ChunkStore(store, chunks_key="chunks").upload(str(local), "run/checkpoint-2")
+    assert second["uploaded_bytes"] == 0
+    chunks.stats = second
+    assert chunks.dedup_ratio() == float("inf")
+
+
+def test_content_defined_chunks_survive_an_insertion(tmp_path, store):
+    data = np.random.default_rng(1).bytes(8 * 2**20)
+    write(str(tmp_path / "a" / "optimizer.pt"), data)
+    edited = data[: 4 * 2**20] + b"inserted" + data[4 * 2**20 :]
+    write(str(tmp_path / "b" / "optimizer.pt"), edited)
+    chunks = ChunkStore(store)
+
+    chunks.upload(str(tmp_path / "a"), "a")
+    stats = chunks.upload(str(tmp_path / "b"), "b")
+    # only the chunks around the insertion are new
+    assert 0 < stats["uploaded_bytes"] < len(edited) / 2
+    chunks.download(str(tmp_path / "restored"), "b")
+    assert read_tree(tmp_path / "restored") == read_tree(tmp_path / "b")
+
+
+def test_safetensors_split_at_tensor_boundaries(tmp_path, store):
+    safetensors_numpy = pytest.importorskip("safetensors.numpy")
+    rng = np.random.default_rng(2)
+    frozen = rng.standard_normal((256, 256)).astype(np.float32)
+    path = str(tmp_path / "a" / "model.safetensors")
+    os.makedirs(os.path.dirname(path))
+    safetensors_numpy.save_file({"frozen": frozen, "head": np.zeros(8, np.float32)}, path)
+    chunks = list(iter_chunks(path))
+    assert frozen.tobytes() in chunks
+
+    edited = str(tmp_path / "b" / "model.safetensors")
+    os.makedirs(os.path.dirname(edited))
+    safetensors_numpy.save_file({"frozen": frozen, "head": np.ones(8, np.float32)}, edited)
+    store_chunks = ChunkStore(store)
+    store_chunks.upload(str(tmp_path / "a"), "a")
+    # only the header and the changed tensor are sent again
+    assert store_chunks.upload(str(tmp_path / "b"), "b")["uploaded_bytes"] < frozen.nbytes
+
+
+def test_missing_manifest_raises(tmp_path, store):
+    with pytest.raises(ValueError):
+        ChunkStore(store).download(str(tmp_path / "out"), "never-uploaded")
@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+from datastore import MANIFEST_NAME
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_missing_keys_are_checked_again(tmp_path, store):
+    assert not store.already_exists("splits")
+    assert store._list_objects("splits") == {}
+    # another task writes the key, bypassing this process's memos
+    store.backend.put_bytes(os.path.join("splits", "model_splits.json"), b"[]")
+    assert store.already_exists("splits")
+    assert list(store._list_objects("splits")) == ["model_splits.json"]
+
+
+def test_upload_invalidates_listings_of_parent_prefixes(tmp_path, store):
+    write(str(tmp_path / "a" / "x"), b"x")
+    store.upload(str(tmp_path / "a"), "run/a")
+    assert set(store._list_objects("run")) == {"a/x", f"a/{MANIFEST_NAME}"}
+
+    write(str(tmp_path / "b" / "y"), b"y")
+    store.upload(str(tmp_path / "b"), "run/b")
+    store.put_json("run/index.json", {"done": True})
+    assert set(store._list_objects("run")) == {
+        "a/x",
+        f"a/{MANIFEST_NAME}",
+        "b/y",
+        f"b/{MANIFEST_NAME}",
+        "index.json",
+    }
+
+
+def read_tree(root):
+    tree = {}
+    for path, _, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(path, name), "rb") as f:
+                tree[os.path.relpath(os.path.join(path, name), root)] = f.read()
+    return tree
+
+
+def sample_tree(root):
+    write(os.path.join(root, "a.txt"), b"a" * 1000)
+    write(os.path.join(root, "nested", "b.bin"), os.urandom(5000))
+    write(os.path.join(root, "nested", "deeper", "c"), b"")
+    return read_tree(root)
+
+
+def test_upload_download_round_trip(tmp_path, store):
+    tree = sample_tree(str(tmp_path / "src"))
+    store.upload(str(tmp_path / "src"), "k")
+    assert store.already_exists("k")
+    store.download(str(tmp_path / "dst"), "k")
+    assert read_tree(tmp_path / "dst") == tree
+    assert set(store._read_manifest("k")["files"]) == set(tree)
+
+
+def test_download_of_a_missing_key_raises(tmp_path, store):
+    with pytest.raises(ValueError):
+        store.download(str(tmp_path / "dst"), "missing")
+
+
+def test_download_cache_links_cached_objects(tmp_path, store, monkeypatch):
+    from datastore import DownloadCache
+
+    store._cache_dir = str(tmp_path / "cache")
+    tree = sample_tree(str(tmp_path / "src"))
+    store.upload(str(tmp_path / "src"), "k")
+    store.download(str(tmp_path / "first"), "k")
+    assert read_tree(tmp_path / "first") == tree
+
+    # an unchanged prefix is taken from the cache manifest, without listing or fetching
+    listed, fetched = [], []
+    backend = type(store.backend)
+    iter_objects, get_file = backend.iter_objects, backend.get_file
+    monkeypatch.setattr(
+        backend,
+        "iter_objects",
+        lambda self, prefix: listed.append(prefix) or iter_objects(self, prefix),
+    )
+    monkeypatch.setattr(
+        backend,
+        "get_file",
+        lambda self, key, path: fetched.append(key) or get_file(self, key, path),
+    )
+    store.download(str(tmp_path / "second"), "k")
+    assert read_tree(tmp_path / "second") == tree
+    assert listed == [] and fetched == []
+    first, second = (os.stat(tmp_path / name / "a.txt").st_ino for name in ("first", "second"))
+    assert first == second
+
+    # the budget evicts least recently used objects
+    cache = DownloadCache(store._cache_dir, max_bytes=0)
+    assert cache.evict() == 0
+
+
+def test_delta_upload_sends_changes_and_deletes_stale_files(tmp_path, store):
+    src = str(tmp_path / "src")
+    sample_tree(src)
+    store.upload(src, "k")
+    write(os.path.join(src, "a.txt"), b"b" * 1000)
+    os.remove(os.path.join(src, "nested", "b.bin"))
+    write(os.path.join(src, "new.txt"), b"new")
+
+    stats = store.upload(src, "k", delta=True)
+    assert stats["files_sent"] == 2
+    assert stats["files_skipped"] == 1
+    assert stats["files_deleted"] == 1
+    assert "nested/b.bin" not in dict(store.backend.iter_objects("k"))
+    store.download(str(tmp_path / "dst"), "k")
+    assert read_tree(tmp_path / "dst") == read_tree(src)
+
+    stats = store.upload(src, "k", delta=True)
+    assert stats["files_sent"] == 0 and stats["files_deleted"] == 0
+
+
+@pytest.mark.parametrize("codec", ["zstd", "lz4"])
+def test_codec_round_trip(tmp_path, store, codec):
+    pytest.importorskip({"zstd": "zstandard", "lz4": "lz4.frame"}[codec])
+    src = str(tmp_path / "src")
+    tree = sample_tree(src)
+    write(os.path.join(src, "zeros"), bytes(2**20))
+    tree["zeros"] = bytes(2**20)
+    store.upload(src, "k", codec=codec)
+    stored = dict(store.backend.iter_objects("k"))
+    assert stored["zeros"]["size"] < 2**20 // 10
+    assert store._read_manifest("k")["files"]["zeros"]["codec"] == codec
+    store.download(str(tmp_path / "dst"), "k")
+    assert read_tree(tmp_path / "dst") == tree
+
+
+def test_unknown_codec_is_rejected(tmp_path, store):
+    write(str(tmp_path / "f"), b"x")
+    with pytest.raises(ValueError):
+        store.upload(str(tmp_path / "f"), "k", codec="gzip")
+
+
+def test_hf_dataset_round_trip_and_row_ranges(tmp_path, store):
+    datasets = pytest.importorskip("datasets")
+    dataset = datasets.Dataset.from_dict(
+        {"row": list(range(1000)), "text": [str(i) * 50 for i in range(1000)]}
+    )
+    store.upload_hf_dataset(dataset, "ds", shard_bytes=20000, batch_rows=100)
+    assert len(store._hf_shards("ds")) > 2
+
+    store.download(str(tmp_path / "full"), "ds")
+    assert datasets.load_from_disk(str(tmp_path / "full"))["row"] == dataset["row"]
+
+    rows = store.download_hf_dataset_rows(str(tmp_path / "rows"), 250, 520, "ds")
+    assert rows["row"] == list(range(250, 520))
+    # only the shards holding the range were fetched
+    assert len(os.listdir(tmp_path / "rows")) < len(store._hf_shards("ds"))
+    with pytest.raises(ValueError):
+        store.download_hf_dataset_rows(str(tmp_path / "empty"), 1000, store_key="ds")